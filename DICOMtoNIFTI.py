@@ -8,6 +8,8 @@ import concurrent.futures
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import time # For potential timing/debugging
 from dicom2nifti import settings
+from dicom2nifti.common import is_dicom_file, is_valid_imaging_dicom
+from dicom2nifti.convert_dicom import dicom_array_to_nifti
 from pydicom.errors import InvalidDicomError
 import numpy as np
 import nibabel as nib
@@ -16,6 +18,8 @@ from typing import List, Pattern, Tuple, Set, Dict, Optional
 from dataclasses import dataclass, field
 from pydantic import BaseModel, Field, DirectoryPath, FilePath, field_validator, ConfigDict
 from abc import ABC, abstractmethod
+from utils.dicom_headers import DicomHeader
+from utils.header_index import HeaderIndex
 
 
 settings.disable_validate_slice_increment()
@@ -75,6 +79,7 @@ class NiftiConfig(BaseModel):
     max_workers: int = Field(default=14, gt=0)
     use_only_name: bool = True
     max_workers_dicom: int = Field(default=32, gt=0)
+    in_memory_sort: bool = False # group the series from the header index and convert file lists, no sortiert/ hardlinks
 
     # Automatically compile indicators into patterns if they exist
     def get_patterns(self) -> List[re.Pattern]:
@@ -88,9 +93,14 @@ class NiftiConfig(BaseModel):
         return Path(v) if isinstance(v, str) else v
 
 class ConversionTask(BaseModel):
-    input_dir: DirectoryPath
+    input_dir: Optional[DirectoryPath] = None # sorted series folder
+    files: Optional[List[str]] = None # or the series' files directly (in_memory_sort)
     output_path: Path # Not yet a FilePath because it doesn't exist yet
     model_config=ConfigDict(arbitrary_types_allowed = True)
+
+    @property
+    def source(self) -> str:
+        return str(self.input_dir) if self.input_dir is not None else self.output_path.name.removesuffix(".nii.gz")
         
         
 class BaseConverter(ABC):
@@ -114,16 +124,24 @@ class NiftiParallelConverter(BaseConverter):
         start_time = time.time()
         print(f"{'-'*20}\nStep 1: Sorting DICOM files...")
         
-        # 1. Sort DICOMs (utilizing your existing DICOM_splitter function)
-        sort_dir, nifti_out_dir = DICOM_splitter(
-            self.config.raw_path, 
-            max_workers=self.config.max_workers_dicom, 
-            use_only_name=self.config.use_only_name
-        )
+        # 1. Sort DICOMs (utilizing your existing DICOM_splitter function), or only group them in memory
+        series = None
+        if self.config.in_memory_sort:
+            sort_dir, nifti_out_dir, series = DICOM_grouper(
+                self.config.raw_path,
+                max_workers=self.config.max_workers_dicom,
+                use_only_name=self.config.use_only_name
+            )
+        else:
+            sort_dir, nifti_out_dir = DICOM_splitter(
+                self.config.raw_path, 
+                max_workers=self.config.max_workers_dicom, 
+                use_only_name=self.config.use_only_name
+            )
         
         # 2. Prepare validated tasks
         print("Step 2: Preparing conversion tasks...")
-        tasks = self._prepare_tasks(sort_dir, nifti_out_dir)
+        tasks = self._prepare_tasks(sort_dir, nifti_out_dir, series)
         
         if not tasks:
             print("No series found matching the criteria.")
@@ -140,26 +158,30 @@ class NiftiParallelConverter(BaseConverter):
                     results.append(future.result())
                 except Exception as exc:
                     task = future_to_task[future]
-                    results.append((str(task.input_dir), False, str(exc)))
+                    results.append((task.source, False, str(exc)))
 
         # 4. Summary Reporting
         self._report(results, start_time)
 
-    def _prepare_tasks(self, sort_dir: Path, nifti_out_dir: Path) -> List[ConversionTask]:
+    def _prepare_tasks(self, sort_dir: Optional[Path], nifti_out_dir: Path,
+                       series: Optional[Dict[str, Tuple[DicomHeader, List[str]]]] = None) -> List[ConversionTask]:
+        """Series to convert, the sorted folders or, with series from DICOM_grouper, their file lists."""
         tasks = []
         # Compile patterns once
         patterns = [build_pattern(clean_string(ind)) for ind in (self.config.scans_indicators or [])]
         group_pat = re.compile(re.escape(self.config.group_filter), re.IGNORECASE) if self.config.group_filter else None
 
-        for item_name in os.listdir(sort_dir):
-            full_path = sort_dir / item_name
-            if not full_path.is_dir(): continue
+        if series is None:
+            descriptions = self._series_descriptions(sort_dir)
+        else:
+            descriptions = {item_name: clean_string(header.series_description) for item_name, (header, _) in series.items()}
+
+        for item_name, series_desc in descriptions.items():
+            full_path = sort_dir / item_name if series is None else None
+            if full_path is not None and not full_path.is_dir(): continue
             
             should_convert = self.config.use_default
             if not should_convert:
-                parts = item_name.split("_")
-                series_desc = "_".join(parts[3:]) if len(parts) >= 4 else ""
-                
                 match_ind = any(p.search(series_desc) for p in patterns) if patterns else False
                 match_grp = bool(group_pat.search(item_name)) if group_pat else False
                 should_convert = match_ind or match_grp
@@ -167,18 +189,31 @@ class NiftiParallelConverter(BaseConverter):
             if should_convert:
                 tasks.append(ConversionTask(
                     input_dir=full_path, 
+                    files=series[item_name][1] if series is not None else None,
                     output_path=nifti_out_dir / f"{item_name}.nii.gz"
                 ))
         return tasks
 
+    def _series_descriptions(self, sort_dir: Path) -> Dict[str, str]:
+        """Series folder -> cleaned SeriesDescription, from the header index DICOM_splitter just updated instead of parsing folder names."""
+        headers = HeaderIndex(self.config.raw_path).headers()
+        if headers:
+            return {series_folder_name(h, self.config.use_only_name): clean_string(h.series_description) for h in headers.values()}
+        # no index (read-only share), the description is everything after the third underscore of the folder name
+        return {item_name: "_".join(item_name.split("_")[3:]) for item_name in os.listdir(sort_dir)}
+
     @staticmethod
     def process_item(task: ConversionTask) -> Tuple[str, bool, str]:
         """Static method for better cross-platform process serialization."""
         try:
-            print(f"Attempting conversion: {task.input_dir} -> {task.output_path}")
+            print(f"Attempting conversion: {task.source} -> {task.output_path}")
             task.output_path.parent.mkdir(parents=True, exist_ok=True)
             # Your original conversion + RAS reorientation logic here
-            dicom2nifti.dicom_series_to_nifti(str(task.input_dir), str(task.output_path), reorient_nifti=True)
+            if task.files is None:
+                dicom2nifti.dicom_series_to_nifti(str(task.input_dir), str(task.output_path), reorient_nifti=True)
+            else:
+                # same as dicom_series_to_nifti minus the copy of the folder to a temp dir, dicom2nifti never writes to the inputs
+                dicom_array_to_nifti(read_dicom_files(task.files), str(task.output_path), reorient_nifti=True)
             
             nii = nib.load(str(task.output_path))
             orig_orient = io_orientation(nii.affine)
@@ -189,16 +224,16 @@ class NiftiParallelConverter(BaseConverter):
                 nii_ras = nii.as_reoriented(transform)
                 nib.save(nii_ras, str(task.output_path))
                 
-            return (str(task.input_dir), True, str(task.output_path))
+            return (task.source, True, str(task.output_path))
         except Exception as e:
-            error_msg = f"Failed conversion for {task.input_dir.name}: {e}"
+            error_msg = f"Failed conversion for {Path(task.source).name}: {e}"
             print(error_msg)
             if task.output_path.exists():
                 try:
                     os.remove(task.output_path)
                 except Exception:
                     pass
-            return (str(task.input_dir), False, str(e))
+            return (task.source, False, str(e))
 
     def _report(self, results, start_time):
         success = sum(1 for r in results if r[1])
@@ -212,6 +247,66 @@ class NiftiParallelConverter(BaseConverter):
     
 
 
+def series_folder_name(header: DicomHeader, use_only_name: bool = False) -> str:
+    """Name of the sorted series folder, e.g. ID_Name_Series3@Study_Description."""
+    pid = clean_string(header.patient_id)
+    pname = clean_string(header.patient_name)
+    sdesc = clean_string(header.series_description)
+    snum = header.series_number
+    stdesc = clean_string(header.study_description)
+    if use_only_name:
+        return f"{pname}_{pname}_Series{snum}@{stdesc}_{sdesc}"
+    return f"{pid}_{pname}_Series{snum}@{stdesc}_{sdesc}"  #some ids are super annoying, so if the have timecodes etc or are super long, and not needed for identifying, use the double name and clean later 
+
+
+def read_dicom_files(files: List[str]) -> list:
+    """dicom2nifti's read_dicom_directory for a list of files: the imaging DICOMs among them, pixel data read on access."""
+    dicom_input = []
+    for file_path in files:
+        if is_dicom_file(file_path):
+            dicom_headers = pydicom.dcmread(file_path, defer_size="1 KB", force=settings.pydicom_read_force)
+            if is_valid_imaging_dicom(dicom_headers):
+                dicom_input.append(dicom_headers)
+    return dicom_input
+
+
+def DICOM_grouper(path : str | Path , max_workers : int = 32, use_only_name : bool = False) -> Tuple[None, Path, Dict[str, Tuple[DicomHeader, List[str]]]]:
+    """
+    DICOM_splitter without the sortiert/ tree: groups the files into the same series (and names) from the header index
+    and returns them as {series folder name: (header, files)}. No link per file, works on shares without hardlinks.
+    """
+    p = Path(path)
+    nifti_out_dir = p.parent / 'NIFTI'
+    nifti_out_dir.mkdir(exist_ok=True)
+
+    print(f"Grouping DICOMs from: {p}")
+    print(f"Output NIFTI files to: {nifti_out_dir}")
+    print(f"Using only PatientName for folder naming: {use_only_name}")
+
+    series = {}
+    error_files = 0
+    for original_file_path, header in HeaderIndex(p).scan(max_workers=max_workers):
+        if isinstance(header, Exception):
+            print(f"Failed reading {original_file_path}: {header}")
+            error_files += 1
+            continue
+        series.setdefault(series_folder_name(header, use_only_name), (header, []))[1].append(original_file_path)
+
+    # the sorted folders hold one file per name, keep the same first file per name (in path order) for each series
+    for item_name, (header, files) in series.items():
+        by_name = {}
+        for file_path in sorted(files):
+            by_name.setdefault(os.path.basename(file_path), file_path)
+        series[item_name] = (header, sorted(by_name.values()))
+
+    print("\nDICOM Grouping Summary:")
+    print(f"  Series: {len(series)}")
+    print(f"  Files: {sum(len(files) for _, files in series.values())}")
+    print(f"  Errors: {error_files}")
+
+    return None, nifti_out_dir, series
+
+
 def DICOM_splitter(path : str | Path , max_workers : int = 32, use_only_name : bool = False) -> Tuple[Path, Path]:
     """Splits a potentially directory of Dicom files into nicely named directory one for each scan/document . """
     p = Path(path)
@@ -230,64 +325,33 @@ def DICOM_splitter(path : str | Path , max_workers : int = 32, use_only_name : b
     skipped_files = 0
     error_files = 0
 
-    needed_tags = [
-        "PatientID",
-        "PatientName",
-        "StudyDescription",
-        "SeriesDescription",
-        "SeriesNumber"]
-
     files_to_link = []
-    known_dirs = set()  # avoid repeated mkdir costs
+    known_dirs = {}  # folder -> file names already in it, one mkdir and one listdir per folder instead of an exists() per file
 
     # -----------------------------
     # PASS 1: FAST SCAN + PARSE
     # -----------------------------
+    # the walk feeds a thread pool of header reads, only the folder bookkeeping happens here.
+    # Files already in the header index next to the raw folder (same size and mtime) are not read again
     print("Scanning DICOM files and preparing copy list...")
-    for original_file_path in p.rglob("*"):
-        if not original_file_path.is_file():
+    for original_file_path, header in HeaderIndex(p).scan(max_workers=max_workers):
+        if isinstance(header, Exception):
+            print(f"Failed reading {original_file_path}: {header}")
+            error_files += 1
             continue
 
-        try:
-            dcm = pydicom.dcmread(
-                original_file_path,
-                stop_before_pixels=True,
-                force=True,
-                specific_tags=needed_tags,
-            )
-
-            # Extract tags
-            pid = getattr(dcm, "PatientID", "UnknownID")
-            pname = getattr(dcm, "PatientName", "UnknownName")
-            sdesc = getattr(dcm, "SeriesDescription", "UnknownSeries")
-            snum = getattr(dcm, "SeriesNumber", 0)
-            stdesc = getattr(dcm, "StudyDescription", "unknownStudy")
-
-            pid = clean_string(str(pid))
-            pname = clean_string(str(pname))
-            sdesc = clean_string(str(sdesc))
-            snum = str(snum)
-            stdesc = clean_string(str(stdesc))
-            if use_only_name:
-                folder = sort_dir / f"{pname}_{pname}_Series{snum}@{stdesc}_{sdesc}"
-            else:
-                folder = sort_dir / f"{pid}_{pname}_Series{snum}@{stdesc}_{sdesc}"  #some ids are super annoying, so if the have timecodes etc or are super long, and not needed for identifying, use the double name and clean later 
-
-            # Create folder once
-            if folder not in known_dirs:
-                folder.mkdir(exist_ok=True, parents=True)
-                known_dirs.add(folder)
+        folder = sort_dir / series_folder_name(header, use_only_name)
 
-            target = folder / original_file_path.name
+        # Create folder once
+        if folder not in known_dirs:
+            folder.mkdir(exist_ok=True, parents=True)
+            known_dirs[folder] = set(os.listdir(folder))
 
-            if not target.exists():
-                files_to_link.append((original_file_path, target))
-            else:
-                skipped_files += 1
-
-        except Exception as e:
-            print(f"Failed reading {original_file_path}: {e}")
-            error_files += 1
+        file_name = os.path.basename(original_file_path)
+        if file_name not in known_dirs[folder]:
+            files_to_link.append((original_file_path, folder / file_name))
+        else:
+            skipped_files += 1
     
     # ------------------------------------------------------
     # PASS 2: Link (I/O bound → threads are ideal)
@@ -19,6 +19,7 @@ import threading
 import queue
 import dicom2nifti
 import pydicom 
+import bisect
 import dicom2nifti.settings as settings 
 from nnunetv2.paths import nnUNet_results, nnUNet_raw 
 import torch
@@ -26,7 +27,6 @@ from batchgenerators.utilities.file_and_folder_operations import join
 from nnunetv2.inference.predict_from_raw_data import nnUNetPredictor
 from nnunetv2.training.nnUNetTrainer.variants.network_architecture.nnUNetTrainerLoRA import create_lora_predictor
 import subprocess
-from utils.json_renamer import rename_keys
 import nibabel as nib
 from nibabel import load, Nifti1Image, save 
 from skimage import measure
@@ -37,13 +37,15 @@ from multi_stl import process_directory_parallel, MeshSmoothingConfig, STLProces
 import shutil
 from cutting import masking, zcut, cut_volume
 from DICOMtoNIFTI import raw_data_to_nifti_parallel, nifti_renamer, NiftiConfig, NiftiParallelConverter
-from modifier import  stl_renamer_with_lut
+from utils.indicator_discovery import discover_indicators
 from utils.mailing import send_mail
 import ttkbootstrap as tb
 from ttkbootstrap.constants import *
 import logging
 from utils.logging_tool import gui_log_output, SuppressStdout, TerminalOnlyStdout
 from utils.analytics import calculate_hu_stats
+from utils.nnunet_handoff import predict_labelmaps, supports_in_memory
+from concurrent.futures import ThreadPoolExecutor
 with open("ids.json", "r") as ids:
     id_dict = json.load(ids)
 with open("labels.json", "r") as labels:
@@ -88,6 +90,7 @@ class AppParameters(BaseModel):
     group_filter: Optional[str] = None
     use_default_indicators: bool = True
     name_only: bool = True
+    in_memory_sort: bool = False # group the series from the header index instead of hardlinking them into sortiert/
     
     # nnUNet Details
     dataset_id: str = Field(..., alias="ID") # Maps 'ID' from GUI to 'dataset_id'
@@ -100,6 +103,7 @@ class AppParameters(BaseModel):
     use_meshrepair: bool = True
     remove_islands: bool = True
     run_analytics: bool = False
+    in_memory_stl: bool = False # hand the predictions to the STL workers as arrays, the labelmaps are written in the background
     
     # Notifications
     mail: Optional[EmailStr] = None # EmailStr validates format automatically
@@ -189,6 +193,10 @@ class ParameterGUI:
         self.resume_event = threading.Event()
         self.resume_event.set()
 
+        # Bumped for every new input folder, results of an older indicator scan are dropped
+        self.indicator_scan_generation = 0
+        self.scanned_indicators = [] # sorted, same order as their menu entries (custom ones come after them)
+
 
 
         # Create main frame with padding
@@ -520,6 +528,14 @@ class ParameterGUI:
         )
         self.pause_check.grid(row=16, column=0, columnspan=1, sticky=tk.W, pady=(0, 10))
 
+        self.in_memory_var = tk.BooleanVar(value=False)
+        self.in_memory_check = tb.Checkbutton(preprocessing_frame, text="Pass segmentations to the STL conversion in memory (not for cascade or split runs)", variable=self.in_memory_var)
+        self.in_memory_check.grid(row=17, column=0, columnspan=1, sticky=tk.W, pady=(0, 10))
+
+        self.in_memory_sort_var = tk.BooleanVar(value=False)
+        self.in_memory_sort_check = tb.Checkbutton(preprocessing_frame, text="Group the DICOM series in memory, no sortiert/ folder (for shares without hardlinks)", variable=self.in_memory_sort_var)
+        self.in_memory_sort_check.grid(row=18, column=0, columnspan=1, sticky=tk.W, pady=(0, 10))
+
         # Button frame at the bottom
         button_frame = ttk.Frame(main_frame)
         button_frame.grid(row=4, column=0, columnspan=2, pady=(20, 0))
@@ -562,6 +578,8 @@ class ParameterGUI:
     
         path = self.input_path.get()
         if os.path.isdir(path):
+            self.indicator_scan_generation += 1
+            self.scanned_indicators = []
             # Reset indicator menu
             self.dropdown_menu.delete(0, tk.END)
             self.selected_indicators.clear()
@@ -571,62 +589,52 @@ class ParameterGUI:
             self.indicators_menu.config(text="Scanning for indicators...")
             
             # Start scanning thread
-            scan_thread = threading.Thread(target=self.scan_indicators_thread, args=(path,))  #this prevents UI freeze
+            scan_thread = threading.Thread(target=self.scan_indicators_thread, args=(path, self.indicator_scan_generation))  #this prevents UI freeze
             scan_thread.daemon = True
             scan_thread.start()
 
-    def scan_indicators_thread(self, path):
-        """Thread function to scan for indicators"""
+    def scan_indicators_thread(self, path, generation):
+        """Thread function to scan for indicators, each one goes to the dropdown as soon as it is found"""
         try:
-            indicators = set()
-            nifti_found : bool = False
-            # Walk through directory and find DICOM files
-            for root, dirs, files in os.walk(path):
-                if nifti_found:
-                    break
-                for file in files:
-                    if file.endswith(('.nii', '.nii.gz')):
-                        nifti_found = True
-                        break # If a NIFTI is found, stop scanning for DICOM indicators
-                    file_path = os.path.join(root, file)
-                    try:
-                        # Try to read as DICOM
-                        dicom_data = pydicom.dcmread(file_path, stop_before_pixels=True)
-                        
-                        # Check for SeriesDescription
-                        if hasattr(dicom_data, 'SeriesDescription'):
-                            desc = dicom_data.SeriesDescription
-                            if desc:
-                                indicators.add(desc)
-    
-                        
-                        # Break after finding a few DICOM files with indicators
-                    except Exception:
-                        continue  # Skip non-DICOM files
-            
+            stale = lambda: generation != self.indicator_scan_generation  # another folder was selected meanwhile
+            # one file per folder first, then the full pass through the header index
+            nifti_file = discover_indicators(
+                path,
+                on_indicator=lambda desc: self.root.after(0, self.add_indicator_option, desc, generation),
+                should_stop=stale,
+            )
             
             # Update UI in main thread
-            self.root.after(0, lambda: self.update_indicators_options(sorted(indicators), nifti_found))
+            if not stale():
+                self.root.after(0, self.finish_indicator_scan, generation, nifti_file is not None)
             
         except Exception as e:
             self.root.after(0, lambda: self.status_var.set(f"Error scanning indicators: {str(e)}"))
 
-    def update_indicators_options(self, indicators, nifti_found=False):
-        """Update the indicators menu with the scanned indicators"""
-        # Clear the menu and selected indicators
-        self.dropdown_menu.delete(0, tk.END)
-        self.selected_indicators.clear()
-        
-        # Add checkbuttons for each available indicator
-        for indicator in indicators:
-            var = tk.BooleanVar(value=False)
-            self.dropdown_menu.add_checkbutton(
-                label=indicator,
-                variable=var,
-                command=lambda ind=indicator: self.toggle_indicator(ind)
-            )
+    def add_indicator_option(self, indicator, generation):
+        """Add one scanned indicator to the menu while the scan is still running"""
+        if generation != self.indicator_scan_generation:
+            return
+        # insert at its sorted position, so the menu looks the same whatever order the scan finds them in
+        position = bisect.bisect(self.scanned_indicators, indicator)
+        self.scanned_indicators.insert(position, indicator)
+        var = tk.BooleanVar(value=False)
+        self.dropdown_menu.insert_checkbutton(
+            position,
+            label=indicator,
+            variable=var,
+            command=lambda ind=indicator: self.toggle_indicator(ind)
+        )
+        if len(self.scanned_indicators) == 1 and not self.selected_indicators:
+            self.indicators_menu.config(text="Select Indicators")
+        self.status_var.set(f"Scanning... found {len(self.scanned_indicators)} indicators so far")
+
+    def finish_indicator_scan(self, generation, nifti_found=False):
+        """Final status once the full pass is done, switches to NIfTI input if there were only NIfTIs"""
+        if generation != self.indicator_scan_generation:
+            return
 
-        if not indicators and nifti_found:
+        if not self.scanned_indicators and nifti_found:
             # 1. Toggle the BooleanVar
             self.input_nifti.set(True)
             
@@ -639,13 +647,10 @@ class ParameterGUI:
             )
             toast.show_toast()
         
-        # Update the menubutton text
-        self.update_menubutton_text()
-        
         # Update status
-        if indicators:
-            self.indicators_menu.config(text="Select Indicators")
-            self.status_var.set(f"Found {len(indicators)} indicators")
+        if self.scanned_indicators:
+            self.update_menubutton_text()
+            self.status_var.set(f"Found {len(self.scanned_indicators)} indicators")
         elif self.input_nifti.get():
             self.indicators_menu.config(text="NIFTIS detected")
             self.status_var.set("No indicators found in the selected directory")
@@ -928,6 +933,7 @@ class ParameterGUI:
         
 
         """Process the input data using the parameters from the GUI"""
+        archive_pool = None # background NIfTI writes of the in-memory handoff, awaited in the finally below
         try:
             input_path = params.input_path
             stl_output_path = params.stl_output_path or (input_path.parent / "stl")
@@ -956,7 +962,7 @@ class ParameterGUI:
                 if not params.nifti_input: 
                     # Step 1: Convert DICOM to NIfTI 
                     self.progress_queue.put(ProgressEvent(10, "Converting DICOM to NIfTI..."))
-                    nifti_config =  NiftiConfig(raw_path = input_path, scans_indicators = scan_indicators, group_filter = group_filter, use_default = use_default, use_only_name = params.name_only)
+                    nifti_config =  NiftiConfig(raw_path = input_path, scans_indicators = scan_indicators, group_filter = group_filter, use_default = use_default, use_only_name = params.name_only, in_memory_sort = params.in_memory_sort)
                     converter = NiftiParallelConverter(nifti_config)
                     converter.run()
                     #raw_data_to_nifti_parallel(nifti_config) 
@@ -1069,6 +1075,7 @@ class ParameterGUI:
 
         
             # Step 3: Use nnUNet predictor for segmentation
+            labelmap_feed = None # in-memory handoff only, the predictions are made while the STLs are built
             self.progress_queue.put(ProgressEvent(50, "Setting up nnUNet predictor..."))
             selected_id = params.dataset_id
             configuration = params.configuration
@@ -1160,16 +1167,23 @@ class ParameterGUI:
             
                 self.progress_queue.put(ProgressEvent(60, "Running segmentation..."))
                 print("Starting nnU-Net prediction. Status updates will be suppressed from the log.")
-                with TerminalOnlyStdout():
-                    predictor.predict_from_files(
-                        str(inference_path), 
-                        str(labelmap_output_path),
-                        save_probabilities=False,
-                        overwrite=False,
-                        num_processes_preprocessing=1,
-                        num_processes_segmentation_export=1,
-                        folder_with_segs_from_prev_stage=None, num_parts=1, part_id=0)
-                print("nnUNet segmentation done.")  #set npp and nps back to 2, after shoulder is done
+                if params.in_memory_stl and not params.split_x_axis and supports_in_memory(predictor):
+                    # predicted lazily while the STL workers run, see step 4
+                    archive_pool = ThreadPoolExecutor(max_workers=1)
+                    labelmap_feed = predict_labelmaps(predictor, inference_path, labelmap_output_path, archive_pool)
+                else:
+                    if params.in_memory_stl:
+                        print("In-memory STL handoff needs a non-split run with nnUNet's SimpleITK reader, writing labelmaps first.")
+                    with TerminalOnlyStdout():
+                        predictor.predict_from_files(
+                            str(inference_path), 
+                            str(labelmap_output_path),
+                            save_probabilities=False,
+                            overwrite=False,
+                            num_processes_preprocessing=1,
+                            num_processes_segmentation_export=1,
+                            folder_with_segs_from_prev_stage=None, num_parts=1, part_id=0)
+                    print("nnUNet segmentation done.")  #set npp and nps back to 2, after shoulder is done
 
             #Masking after segmentation, should not cause problems in the segmentation is faster and background is 0 for every file 
             
@@ -1179,26 +1193,31 @@ class ParameterGUI:
                         masking(os.path.join(labelmap_output_path,folder))
 
             # Step 4: Convert segmentation to STL files
-            self.progress_queue.put(ProgressEvent(80, "Converting segmentations to STL..."))
+            step_message = "Converting segmentations to STL..." if labelmap_feed is None else "Running segmentation and STL conversion..."
+            self.progress_queue.put(ProgressEvent(80, step_message))
             print("Starting with batched stl conversion.")
             # Get label files from the output directory
             stl_metadata_path = Path(input_path.parent) / "stl_metadata.json"
             selected_params = segment_params[selected_id]
-            stl_config = STLProcessingConfig(input_dir=labelmap_output_path, output_root=stl_output_path, segment_params=selected_params, split=params.split_x_axis, use_pymeshfix=params.use_meshrepair, remove_islands=params.remove_islands, stl_metadata_path=stl_metadata_path)
+            stl_config = STLProcessingConfig(input_dir=labelmap_output_path, output_root=stl_output_path, segment_params=selected_params, split=params.split_x_axis, use_pymeshfix=params.use_meshrepair, remove_islands=params.remove_islands, stl_metadata_path=stl_metadata_path, file_mapping=file_mapping)
             stl_processor = ParallelSTLProcessor(stl_config)
-            stl_processor.run()
+            if labelmap_feed is not None:
+                stl_processor.run(labelmap_feed)
+                archive_pool.shutdown(wait=True)
+                print("nnUNet segmentation done.")
+            else:
+                stl_processor.run()
             # process_directory_parallel(labelmap_output_path, stl_output_path, segment_params=segment_params[selected_id], split=split, use_pymeshfix=meshrepair, remove_islands=remove_islands, max_workers=10, stl_metadata_path=stl_metadata_path)
             
-            self.progress_queue.put(ProgressEvent(90, "STL names back to original names..."))
-            reverse_mapping_number = stl_renamer_with_lut(stl_output_path=stl_output_path, file_mapping=file_mapping)
-            stl_metadata_path = rename_keys(stl_metadata_path, stl_metadata_path, reverse_mapping_number)
+            # the STLs and metadata keys already have the original names (file_mapping), no renaming pass needed
             cleaned_metapath = str(Path(stl_metadata_path).resolve())
             
             #this runs the HU analytics as slicer would, just for way more data 
             if params.run_analytics:
                 self.progress_queue.put(ProgressEvent(95, "Running HU analytics..."))
                 stats_dir = Path(input_path.parent) / "HU_Analytics"
-                calculate_hu_stats(inference_path, labelmap_output_path, file_mapping, stats_dir, task_id= selected_id, labels_dict= labels_dict, stl_metadata_path=cleaned_metapath)
+                calculate_hu_stats(inference_path, labelmap_output_path, file_mapping, stats_dir, task_id= selected_id, labels_dict= labels_dict, stl_metadata_path=cleaned_metapath,
+                                   label_histograms=stl_processor.label_histograms())
 
             if params.mail: 
                 send_mail(params.mail, "System Message: nnUNet Script successfull", "nnUNet script finished without errors")
@@ -1233,6 +1252,10 @@ class ParameterGUI:
             self.status_var.set(f"Error: {str(e)}")
             self.progress_queue.put(ProgressEvent(100, "Processing failed", error=str(e)))
             return False
+
+        finally:
+            if archive_pool is not None:
+                archive_pool.shutdown(wait=True) # also on failure, so no labelmap write is left half done
         
     def poll_progress_queue(self):
         """Check progress queue for updates and update UI accordingly"""
@@ -1339,11 +1362,13 @@ class ParameterGUI:
                 folds=[i for var, i in self.folds_checkbuttons if var.get()],
                 split_x_axis=self.split_nifti_var.get(),
                 name_only=self.just_name.get(),
+                in_memory_sort=self.in_memory_sort_var.get(),
                 skip_conversion=self.skip_conversion.get(),
                 nifti_input=self.input_nifti.get(),
                 use_meshrepair=self.meshfix_var.get(),
                 remove_islands=self.islands_var.get(),
                 run_analytics=self.analytics_var.get(),
+                in_memory_stl=self.in_memory_var.get(),
                 mail=final_email,
                 crop=CropConfig(
                     enabled=self.enable_cut.get(),
@@ -7,6 +7,7 @@ import pathlib
 from pathlib import Path
 from nibabel.orientations import axcodes2ornt, io_orientation, ornt_transform
 from typing import List, Tuple, Union 
+from utils.labelmap_io import load_labelmap
 PathLike = Union[str, Path]
 
 def cut_volume(
@@ -172,18 +173,17 @@ def zcut(nii_path : str, lower : int, upper : int , keep_original: bool, backup_
 #this is not the best option but worked so far, cut also properly cut the images, some viewers might struggle with the overlay, and if stuff ges wrong, simply adding is easier
 def masking(nii_path):
     nib.openers.Opener.default_compresslevel = 9 #type: ignore 
-    nii = load(nii_path)
-    volume =  nii.get_fdata() #type: ignore 
+    volume, nii = load_labelmap(nii_path) # labels in their integer dtype, no float64 copies of the whole volume
     affine = nii.affine #type: ignore 
     x_split= volume.shape[0]//2
-    left_data=volume.copy()
+    left_data=volume.astype(np.int16) # astype already copies, the halves are written as int16 as before
     left_data[x_split:,:,:]=0 #zeros out left side of the images which corresponds to the patients right side in the usual position, not with ras anymore 
     suffix_right = 'rechts'
     suffix_left= 'links'
-    right_data= volume.copy()
+    right_data= volume.astype(np.int16)
     right_data[:x_split,:,:] =0
-    img_rechts = Nifti1Image(right_data.astype(np.int16), affine)
-    img_links = Nifti1Image(left_data.astype(np.int16), affine)
+    img_rechts = Nifti1Image(right_data, affine)
+    img_links = Nifti1Image(left_data, affine)
     basename, ext = nii.get_filename().split(os.extsep, 1) #type: ignore 
     out_name_rechts = f'{basename}-{suffix_right}.{ext}'
     out_name_links = f'{basename}-{suffix_left}.{ext}'
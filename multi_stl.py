@@ -3,25 +3,38 @@ import numpy as np
 from skimage import measure
 from scipy import ndimage
 import pyvista as pv
-from stl import mesh
 import os 
-from scipy.ndimage import binary_fill_holes, binary_closing
+from scipy.ndimage import binary_fill_holes
 import pymeshfix
 import logging
 import json 
 import shutil
 import trimesh 
 from pathlib import Path
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from functools import partial
 import multiprocessing as mp
 from utils.stl_metadata import calculate_volume_and_surface_area, save_metadata_to_json
-from typing import List, Dict, Tuple, Optional, Union, Any, TypedDict, Literal 
-from pydantic import BaseModel, Field, DirectoryPath, field_validator, ConfigDict
+from utils.labelmap_io import load_labelmap, label_histogram
+from utils.mesh_export import write_stl, write_mesh, STLWriter, MeshFormat
+from utils.stl_manifest import STLManifest, params_hash
+from utils.write_behind import WriteBehindQueue, shared_write_queue
+from utils.shared_labelmap import InMemoryLabelmap, SharedLabelmap, share_labelmap, load_shared_labelmap, release_shared
+from utils.stage_timing import StageTimer, append_timings, timing_summary
+from utils.mesh_smoothing import smooth_vertices_sparse
+from utils.mesh_conversion import to_polydata, points_of, faces_of
+from typing import List, Dict, Tuple, Optional, Union, Any, TypedDict, Literal, Iterable 
+from pydantic import BaseModel, Field, DirectoryPath, field_validator, model_validator, ConfigDict
 from abc import ABC, abstractmethod
+from dataclasses import dataclass
 import time
+import tempfile
+import uuid
+from collections import deque
 
 
+SmoothingBackend = Literal['pyvista', 'native']
+
 # Define a shortcut for types objects, depre
 class SegmentConfig(TypedDict, total=False):
     label: str
@@ -40,23 +53,50 @@ class MeshSmoothingConfig(BaseModel):
     factor: float = Field(default=0.1, gt=0)
     
     
+class DecimationConfig(BaseModel):
+    """Quadric decimation before the repair, either to a face budget or by a fraction of the faces."""
+    target_faces: Optional[int] = Field(default=None, gt=0)
+    reduction: Optional[float] = Field(default=None, gt=0, lt=1)  # 0.75 removes 3/4 of the faces
+    volume_preservation: bool = True
+
+    @model_validator(mode='after')
+    def one_target(self):
+        if (self.target_faces is None) == (self.reduction is None):
+            raise ValueError("Set either target_faces or reduction for decimation.")
+        return self
+
+
 class LabelConfig(BaseModel):
     label_name: str
     volume_smoothing: float = Field(default=1.0, ge=0)
     mesh_config: MeshSmoothingConfig = Field(default_factory=MeshSmoothingConfig)
+    decimation: Optional[DecimationConfig] = None  # None keeps the full marching cubes resolution
+    mesh_step_size: int = Field(default=1, ge=1)  # marching cubes on every n-th voxel, e.g. 2 for pelvis or femur
+    mesh_resolution_mm: Optional[float] = Field(default=None, gt=0)  # overrides mesh_step_size, step per axis from the voxel spacing
     
 class STLProcessingConfig(BaseModel):
     input_dir: DirectoryPath
     output_root: Path
     segment_params: Dict[int, LabelConfig]
     fill_holes: int = 0
+    fill_holes_mode: Literal['slices', '3d'] = 'slices'  # '3d' only fills cavities closed in 3D, 'slices' also fills holes open in one direction
+    fill_holes_threads: int = Field(default=2, ge=1)  # threads per worker process for the slice filling
     use_pymeshfix: bool = True
     remove_islands: bool = True
     max_workers: Optional[int] = 12
-    batch_size: int = Field(default=50, gt=0)
+    batch_size: int = Field(default=50, gt=0)  # tasks queued in the pool at once, the pool itself lives for the whole run
     resume: bool = True
     stl_metadata_path: Optional[Path] = None
     split: bool = False
+    stl_writer: STLWriter = 'numpy-stl'  # 'native' writes the binary STL without numpy-stl
+    output_format: MeshFormat = 'stl'  # 'ply', '3mf' (zip) and 'glb' store shared vertices once, 3-5x smaller than STL
+    task_granularity: Literal['file', 'label'] = 'file'  # 'label' meshes every label of a file as its own task, for few large scans
+    task_ordering: Literal['cost', 'name'] = 'cost'  # 'cost' submits the biggest files first, 'name' keeps the alphabetical order
+    smoothing_backend: SmoothingBackend = 'pyvista'  # 'native' smooths with sparse matrices (classic Taubin, not VTK's windowed sinc)
+    max_memory_gb: Optional[float] = Field(default=None, gt=0)  # only start tasks while their estimated memory fits, None = no limit
+    write_threads: int = Field(default=1, ge=0)  # writer threads per worker, meshing goes on while files are written, 0 = write inline
+    write_queue_size: int = Field(default=4, gt=0)  # finished meshes waiting for a writer before the worker blocks
+    file_mapping: Optional[Dict[str, dict]] = None  # decoder.json, if given folders, files and metadata keys get the original names right away
     
     
 class STLTask(BaseModel):
@@ -64,8 +104,132 @@ class STLTask(BaseModel):
     input_file: Path
     output_dir: Path
     file_number: str
+    content_hash: Optional[str] = None
+    labels: Optional[List[int]] = None  # only rebuild these labels, None means all configured labels
+    file_prefix: str = ""  # original name + "_" with direct naming, like stl_renamer_with_lut would prefix it
+    metadata_name: Optional[str] = None  # key prefix in stl_metadata.json, None = labelmap name
+    shared: Optional[SharedLabelmap] = None  # labelmap handed over in shared memory, input_file may not exist (yet)
     model_config = ConfigDict(arbitrary_types_allowed=True)
 
+    def selected_params(self, segment_params: Dict[int, 'LabelConfig']) -> Dict[int, 'LabelConfig']:
+        if self.labels is None:
+            return segment_params
+        return {label: params for label, params in segment_params.items() if label in self.labels}
+
+
+class STLLabelTask(BaseModel):
+    """A single label of a file, the worker only gets the padded crop as memory-mapped .npy instead of the whole scan."""
+    file_task: STLTask
+    label: int
+    crop_file: Path
+    offset: List[float]
+    affine: List[List[float]]
+    voxel_count: int = 0
+
+
+@dataclass
+class LabelRegion:
+    """Bounding box and voxel count of a single label inside a labelmap."""
+    label: int
+    bbox: Tuple[slice, ...]
+    voxel_count: int
+
+    def crop(self, label_image: np.ndarray) -> np.ndarray:
+        """Binary mask of the label, restricted to its bounding box."""
+        return label_image[self.bbox] == self.label
+
+    def padded_bbox(self, pad: int, shape: Tuple[int, ...]) -> Tuple[slice, ...]:
+        """Bounding box grown by pad voxels on every side, clipped to the image."""
+        return tuple(slice(max(s.start - pad, 0), min(s.stop + pad, dim)) for s, dim in zip(self.bbox, shape))
+
+    def padded_crop(self, label_image: np.ndarray, pad: int) -> Tuple[np.ndarray, np.ndarray]:
+        """Binary mask inside the padded bounding box plus the voxel offset of that box."""
+        roi = self.padded_bbox(pad, label_image.shape)
+        offset = np.array([s.start for s in roi], dtype=np.float64)
+        return label_image[roi] == self.label, offset
+
+
+def smoothing_padding(sigma: float, truncate: float = 4.0) -> int:
+    """
+    Margin in voxels so a cropped label gives the same result as the full volume.
+    The gaussian kernel reaches int(truncate * sigma + 0.5) voxels (scipy default truncate),
+    hole filling/closing needs 2, one extra layer keeps marching cubes away from the crop border.
+    """
+    return max(int(truncate * float(sigma) + 0.5), 2) + 1
+
+
+# STLProcessingConfig fields that change the meshes, they are part of every label's parameter hash.
+# stl_writer is not one of them, both writers produce the same bytes after the 80 byte header
+MESH_CONFIG_FIELDS = ('fill_holes', 'fill_holes_mode', 'use_pymeshfix', 'remove_islands', 'smoothing_backend', 'output_format')
+
+
+def label_params_hash(params: LabelConfig, config: STLProcessingConfig) -> str:
+    """
+    Hash of everything that goes into the STL of one label, a changed hash means the label is rebuilt.
+    The full dump including defaults is hashed, so changing a default in code rebuilds the labels that used it.
+    """
+    payload = {"label": params.model_dump(mode='json')}
+    payload.update({field: getattr(config, field) for field in MESH_CONFIG_FIELDS})
+    return params_hash(payload)
+
+
+def marching_cubes_steps(params: LabelConfig, affine: np.ndarray) -> np.ndarray:
+    """Voxel step per axis for the marching cubes of a label, from mesh_resolution_mm or mesh_step_size."""
+    if params.mesh_resolution_mm is None:
+        return np.full(3, params.mesh_step_size, dtype=int)
+    spacing = np.linalg.norm(np.asarray(affine)[:3, :3], axis=0)
+    return np.maximum(1, np.rint(params.mesh_resolution_mm / spacing)).astype(int)
+
+
+def estimate_file_cost(path: Path) -> float:
+    """Number of voxels from the NIfTI header (no data is read), the file size if the header can't be read."""
+    try:
+        return float(np.prod(nib.load(str(path)).shape))
+    except Exception:
+        return float(os.path.getsize(path))
+
+
+# Rough memory model for max_memory_gb, per running task
+WORKER_BASE_GB = 0.35  # interpreter with numpy/scipy/vtk/pyvista/trimesh loaded
+LABEL_BOX_FRACTION = 0.25  # largest label box as share of the scan, unknown before the labelmap is read
+BYTES_PER_BOX_VOXEL = 12  # float64 gaussian + masks + marching cubes/mesh arrays, per voxel of the label box
+
+
+def estimate_task_memory_gb(path: Path, label_work: bool = True) -> float:
+    """
+    Peak memory of one file task from the NIfTI header: the labelmap in its disk dtype (twice, while
+    gzip decompresses) plus the per label work arrays on the largest label box.
+    """
+    try:
+        header = nib.load(str(path)).header
+        voxels = float(np.prod(header.get_data_shape()))
+        itemsize = header.get_data_dtype().itemsize
+    except Exception:
+        voxels, itemsize = float(os.path.getsize(path)) * 20, 1 # compressed labelmaps are ~20x smaller
+    return estimate_labelmap_memory_gb(voxels, itemsize, label_work)
+
+
+def estimate_labelmap_memory_gb(voxels: float, itemsize: int, label_work: bool = True) -> float:
+    """Same estimate for a labelmap of known size, also the shared memory copy counts twice."""
+    work = voxels * LABEL_BOX_FRACTION * BYTES_PER_BOX_VOXEL if label_work else 0.0
+    return WORKER_BASE_GB + (2 * voxels * itemsize + work) / 1e9
+
+
+def extract_label_regions(label_image: np.ndarray, labels, histogram: Optional[Dict[int, int]] = None) -> Dict[int, LabelRegion]:
+    """
+    Single pass over the labelmap to find the bounding box of every requested label.
+    The histogram (label_histogram, computed if not given) decides up front which labels are present,
+    if none of them are the bounding box pass is skipped. Labels without voxels are not returned.
+    """
+    if histogram is None:
+        histogram = label_histogram(label_image)
+    wanted = sorted({int(label) for label in labels if int(label) > 0 and histogram.get(int(label), 0) > 0})
+    if not wanted:
+        return {}
+    # find_objects still scans every voxel, max_label only limits the labels that get slices (and the size of the list)
+    slices = ndimage.find_objects(label_image, max_label=wanted[-1])
+    return {label: LabelRegion(label=label, bbox=slices[label - 1], voxel_count=histogram[label]) for label in wanted}
+
 
 
 
@@ -91,32 +255,37 @@ def debug_normals(verts, faces, mag=5.0):
     """Visualizes face normals as arrows."""
     # Create the PyVista mesh
     # Note: faces in PyVista need to be [3, v1, v2, v3, 3, v4, v5, v6...]
-    pv_faces = np.column_stack([np.full(len(faces), 3), faces]).ravel()
-    mesh = pv.PolyData(verts, pv_faces)
+    mesh = to_polydata(verts, faces)
     
     # Compute and plot normals
     # 'mag' controls arrow length; 'use_every' prevents clutter
     mesh.plot_normals(mag=mag, faces=True, show_edges=True, use_every=10, color='red')
 
 #Here the laplacian smooothing should b e avoided, unless in testing weird edge casing to perform an opening, if binary operning does not work, test laplacian, the shrinkage might do it
-def smooth_mesh_pyvista(vertices : np.ndarray, faces : np.ndarray, method : str ='taubin', n_iter : int =100, relaxation_factor : float =0.1) -> np.ndarray:
-    """Smooth a mesh using PyVista's smoothing algorithms."""
+def smooth_mesh_pyvista(vertices : np.ndarray, faces : np.ndarray, method : str ='taubin', n_iter : int =100, relaxation_factor : float =0.1,
+                        backend : SmoothingBackend = 'pyvista') -> np.ndarray:
+    """Smooth a mesh using PyVista's smoothing algorithms, or the sparse matrix kernels with backend='native'."""
     vertices = np.array(vertices, dtype=np.float64)
     original_centroid = np.mean(vertices, axis=0)
     print(f"Original centroid located at {original_centroid}")
-    
-    faces_pv = np.hstack([[3, f[0], f[1], f[2]] for f in faces])
-    mesh_pv : pv.PolyData  = pv.PolyData(vertices, faces_pv)
-    mesh_smoothed: pv.PolyData 
-    temp_mesh: Any = mesh_pv
-    if method == 'laplacian':
-        mesh_smoothed = temp_mesh.smooth(n_iter=n_iter, relaxation_factor=relaxation_factor)
-    elif method == 'taubin':
-        mesh_smoothed = temp_mesh.smooth_taubin(n_iter=n_iter, pass_band=relaxation_factor)
+
+    if backend == 'native':
+        # no VTK round trip, adjacency as CSR once and every iteration is a sparse mat-vec
+        smoothed_vertices = smooth_vertices_sparse(vertices, faces, method=method, n_iter=n_iter, relaxation_factor=relaxation_factor)
+    elif backend == 'pyvista':
+        mesh_pv : pv.PolyData  = to_polydata(vertices, faces)
+        mesh_smoothed: pv.PolyData 
+        temp_mesh: Any = mesh_pv
+        if method == 'laplacian':
+            mesh_smoothed = temp_mesh.smooth(n_iter=n_iter, relaxation_factor=relaxation_factor)
+        elif method == 'taubin':
+            mesh_smoothed = temp_mesh.smooth_taubin(n_iter=n_iter, pass_band=relaxation_factor)
+        else:
+            raise ValueError(f"Unknown smoothing method: {method}")
+        smoothed_vertices = points_of(mesh_smoothed) # the filter output is ours, no copy needed
     else:
-        raise ValueError(f"Unknown smoothing method: {method}")
+        raise ValueError(f"Unknown smoothing backend: {backend}")
     
-    smoothed_vertices = mesh_smoothed.points.astype(np.float64)
     new_centroid = np.mean(smoothed_vertices, axis=0)
     shift = original_centroid - new_centroid
     print(f"Correcting centroid shift of {shift}.")
@@ -124,22 +293,74 @@ def smooth_mesh_pyvista(vertices : np.ndarray, faces : np.ndarray, method : str
     return smoothed_vertices
 
 
+def decimate_mesh_pyvista(vertices : np.ndarray, faces : np.ndarray, decimation : DecimationConfig) -> Tuple[np.ndarray, np.ndarray]:
+    """Quadric decimation (vtkQuadricDecimation) to decimation.target_faces or by decimation.reduction."""
+    if decimation.reduction is not None:
+        reduction = decimation.reduction
+    else:
+        reduction = 1.0 - decimation.target_faces / max(len(faces), 1)
+    if reduction <= 0: # already below the budget
+        return vertices, faces
 
-def fill_holes_3d(segmentation):
-    """Fill small holes in a 3D binary segmentation mask."""
-    filled_segmentation = np.zeros_like(segmentation, dtype=bool)
-    
-    for i in range(segmentation.shape[0]):
-        filled_segmentation[i] = binary_fill_holes(segmentation[i])
-    
-    for i in range(segmentation.shape[1]):
-        filled_segmentation[:, i] = binary_fill_holes(filled_segmentation[:, i])
-    
-    for i in range(segmentation.shape[2]):
-        filled_segmentation[:, :, i] = binary_fill_holes(filled_segmentation[:, :, i])
+    decimated = to_polydata(vertices, faces).decimate(reduction, volume_preservation=decimation.volume_preservation)
+    print(f"Decimated mesh from {len(faces)} to {decimated.n_cells} faces.")
+    return points_of(decimated), faces_of(decimated)
+
+
+def _fill_slice_holes(segmentation: np.ndarray, axis: int) -> np.ndarray:
+    """Same as binary_fill_holes on every 2D slice along axis, with one labelling of the background for the whole stack."""
+    structure = np.zeros((3, 3, 3), dtype=bool)
+    structure[(slice(None),) * axis + (1,)] = ndimage.generate_binary_structure(2, 1)
+    background, _ = ndimage.label(~segmentation, structure=structure)
+
+    # background components touching the edge of their slice are outside, everything else is a hole
+    outside = np.zeros(background.max() + 1, dtype=bool)
+    for edge_axis in range(3):
+        if edge_axis == axis:
+            continue
+        outside[np.take(background, 0, axis=edge_axis)] = True
+        outside[np.take(background, -1, axis=edge_axis)] = True
+    outside[0] = True
+    return segmentation | ~outside[background]
+
+
+def _fill_holes_along(segmentation: np.ndarray, axis: int, max_workers: int) -> np.ndarray:
+    """Slices are independent, so the stack is split into chunks for a thread pool."""
+    if max_workers <= 1 or segmentation.shape[axis] < 2 * max_workers:
+        return _fill_slice_holes(segmentation, axis)
+
+    filled = np.empty(segmentation.shape, dtype=bool)
+    bounds = np.linspace(0, segmentation.shape[axis], max_workers + 1, dtype=int)
+    chunks = [(slice(None),) * axis + (slice(lo, hi),) for lo, hi in zip(bounds[:-1], bounds[1:])]
+
+    def fill(chunk):
+        filled[chunk] = _fill_slice_holes(segmentation[chunk], axis)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        list(pool.map(fill, chunks))
+    return filled
+
+
+def fill_holes_3d(segmentation, mode: str = 'slices', max_workers: int = 1):
+    """
+    Fill small holes in a 3D binary segmentation mask.
+    'slices' fills every 2D slice along all three axes (like before, but each axis in one labelling),
+    '3d' only fills cavities that are closed in 3D. Both end with a 3x3x3 closing.
+    Pass the label crop, not the whole scan.
+    """
+    filled_segmentation = np.asarray(segmentation).astype(bool)
+
+    if mode == '3d':
+        filled_segmentation = binary_fill_holes(filled_segmentation)
+    elif mode == 'slices':
+        for axis in range(3):
+            filled_segmentation = _fill_holes_along(filled_segmentation, axis, max_workers)
+    else:
+        raise ValueError(f"Unknown fill_holes mode: {mode}")
     
-    structure = np.ones((3, 3, 3))
-    filled_segmentation = binary_closing(filled_segmentation, structure=structure)
+    # binary_closing with a 3x3x3 cube, as separable max/min filters (same result, zero border like binary_closing)
+    filled_segmentation = ndimage.maximum_filter(filled_segmentation, size=3, mode='constant', cval=0)
+    filled_segmentation = ndimage.minimum_filter(filled_segmentation, size=3, mode='constant', cval=0)
     print('Filling mesh')
     
     return filled_segmentation.astype(np.uint8)
@@ -172,12 +393,13 @@ def process_single_file(file_info : Tuple[str, str, str | int ], segment_params
         simple_name = Path(file_name).stem.split('.')[0]
         print(f"[PID {os.getpid()}] Processing {file_name}")
         nib.openers.Opener.default_compresslevel = 9 #type: ignore
-        nii_img = nib.load(input_file) #type: ignore
-        nii_data = nii_img.get_fdata() #type: ignore
+        label_image, nii_img = load_labelmap(input_file) # integer dtype as on disk, no float64 copy
         spacing = nii_img.header.get_zooms() #type: ignore
         affine = nii_img.affine #type: ignore
         #orientation = nib.orientations.io_orientation(affine)
         #print(" Image orientation:", orientation)
+        # Integer labels from the loader replace the old np.round / np.isclose fallbacks per label
+        regions = extract_label_regions(label_image, segment_params.keys())
         for label, params in segment_params.items():
             volume_smoothing = params.get('smoothing', 0.1)
             output_label = params.get('label', f"segment_{label}")
@@ -185,23 +407,16 @@ def process_single_file(file_info : Tuple[str, str, str | int ], segment_params
             mesh_iterations = params.get('mesh_smoothing_iterations', 100)  #100 seems to be the default value from literature, works in most cases, and going down to 50 does not make a diffrence
             mesh_factor = params.get('mesh_smoothing_factor', 0.1)  #lower -->  stronger smoothing, it is a low pass band filter 
             
-            # Extract binary segment
-            binary_segment = (nii_data == int(label))
-            segment_voxel_count = np.sum(binary_segment)
-            #This is just for debugging, normally we should get nice ints, but these are our workarounds if something goes wrong in memory 
-            if segment_voxel_count == 0:
-                binary_segment = (np.round(nii_data).astype(int) == int(label))
-                segment_voxel_count = np.sum(binary_segment)
-            
-            if segment_voxel_count == 0:
-                binary_segment = np.isclose(nii_data, float(label), rtol=1e-5, atol=1e-8)
-                segment_voxel_count = np.sum(binary_segment)
-            
+            region = regions.get(int(label))
+            segment_voxel_count = region.voxel_count if region is not None else 0
             print(f"[PID {os.getpid()}] Segment {label} voxel count: {segment_voxel_count}")
             
-            if segment_voxel_count == 0:
+            if region is None:
                 print(f"[PID {os.getpid()}] No voxels found for label {label}")
                 continue
+
+            # Extract binary segment in a padded box around the label, smoothing and meshing only run there
+            binary_segment, offset = region.padded_crop(label_image, smoothing_padding(volume_smoothing))
             
             if fill_holes > 0:
                 binary_segment = fill_holes_3d(binary_segment)
@@ -221,6 +436,7 @@ def process_single_file(file_info : Tuple[str, str, str | int ], segment_params
             except Exception as e:
                 print(f"[PID {os.getpid()}] Marching cubes failed for label {label}: {e}")
                 continue
+            verts += offset # crop back to voxel coordinates of the full image
             
             # Apply affine transformation. This converts voxel coordinates to world coordinates 
             verts = np.hstack([verts, np.ones((verts.shape[0], 1))])
@@ -266,10 +482,6 @@ def process_single_file(file_info : Tuple[str, str, str | int ], segment_params
             #print(volume_mm3, surface_area_mm2)
             simple_name_ = f"{simple_name}_{output_label}"
             metadata_entries.append((simple_name_, {"Mesh_volume_mm3" : volume_mm3, "Surface_Area_mm2": surface_area_mm2}))
-            stl_mesh = mesh.Mesh(np.zeros(faces.shape[0], dtype=mesh.Mesh.dtype))
-            for i, face in enumerate(faces):
-                for j in range(3):
-                    stl_mesh.vectors[i][j] = verts[face[j]] #type: ignore
             
             if "links" in output_dir:
                 output_file = f"{output_dir}/{output_label}_{file_number}_links.stl"
@@ -278,7 +490,7 @@ def process_single_file(file_info : Tuple[str, str, str | int ], segment_params
             else:
                 output_file = f"{output_dir}/{output_label}_{file_number}.stl"
             
-            stl_mesh.save(output_file) #type: ignore 
+            write_stl(output_file, verts, faces)
             print(f"[PID {os.getpid()}] Saved {output_file}")
         
         return (file_name, True, None, metadata_entries)
@@ -435,152 +647,592 @@ def process_directory_parallel(input_dir : PathLike, output_root_dir : PathLike
 
 
 class ParallelSTLProcessor(BaseSurfaceReconstructor):
-    def run(self):
+    def run(self, labelmaps: Optional[Iterable[Union[str, Path, InMemoryLabelmap]]] = None):
+        """
+        Mesh every labelmap in input_dir. With labelmaps (e.g. a generator running the prediction) the files come
+        from there instead, one at a time while the pool works: names of labelmaps in input_dir, or InMemoryLabelmap
+        arrays that go to the workers through shared memory.
+        """
         start_time = time.time()
         self.config.output_root.mkdir(parents=True, exist_ok=True)
-        checkpoint_path = self.config.output_root.parent / ".stl_processing_checkpoint.json"
+        self.checkpoint_path = self.config.output_root.parent / ".stl_processing_checkpoint.json"
         
         # 1. Checkpoint & Task Preparation
-        checkpoint = self._load_checkpoint(checkpoint_path)
-        all_tasks = self._prepare_tasks(checkpoint["completed"])
+        self.manifest = STLManifest(self.checkpoint_path, resume=self.config.resume)
+        self.label_hashes = {label: label_params_hash(params, self.config) for label, params in self.config.segment_params.items()}
+        self.file_hashes = {}
+        self.feed = iter(labelmaps) if labelmaps is not None else None
+        self.shared_blocks = {}  # shared memory name -> block, owned here until the task is done
+        self.archives = []  # (file name, in-memory source hash, pending NIfTI write)
+        all_tasks = self._order_tasks(self._prepare_tasks()) if self.feed is None else []
+        self.manifest.save()
         
-        if not all_tasks:
+        if not all_tasks and self.feed is None:
             print("No files left to process.")
-            return
-
-        print(f"Starting STL conversion for {len(all_tasks)} files...")
-        stl_metadata = {}
-        all_failed = checkpoint["failed"]
-
-        # 2. Batch Execution
-        for i in range(0, len(all_tasks), self.config.batch_size):
-            batch = all_tasks[i : i + self.config.batch_size]
-            print(f"\nProcessing Batch {(i // self.config.batch_size) + 1}...")
-            
-            with ProcessPoolExecutor(max_workers=self.config.max_workers) as executor:
-                futures = {executor.submit(self.process_file, task, self.config): task for task in batch}
-                
-                for future in as_completed(futures):
-                    file_name, success, error, metadata_entries = future.result()
-                    if success:
-                        checkpoint["completed"].append(file_name)
-                        for name, meta in metadata_entries:
-                            stl_metadata[name] = meta
-                        print(f"✓ Completed: {file_name}")
-                    else:
-                        all_failed.append({"file": file_name, "error": error})
-                        print(f"✗ Failed: {file_name}")
+        else:
+            if self.feed is None:
+                print(f"Starting STL conversion for {len(all_tasks)} files ({self.config.task_granularity} tasks)...")
+            else:
+                print(f"Starting STL conversion as the labelmaps arrive ({self.config.task_granularity} tasks)...")
+            self.label_jobs = {}  # file name -> open label tasks, errors and metadata (label granularity only)
+            self.memory_estimates = {}
+            if self.config.max_memory_gb and all_tasks:
+                largest = max(estimate_task_memory_gb(task.input_file) for task in all_tasks)
+                print(f"Memory budget {self.config.max_memory_gb} GB, largest file needs ~{largest:.1f} GB "
+                      f"(~{max(1, int(self.config.max_memory_gb // largest))} of those at once).")
+            # stage timings per (file, label) as JSON lines next to the metadata
+            self.timings = []
+            self.timings_path = (self.config.stl_metadata_path.parent if self.config.stl_metadata_path else self.config.output_root.parent) / "stl_timings.jsonl"
+            self.timings_path.write_text("")
+            self.crop_dir = None
+            if self.config.task_granularity == 'label':
+                # local temp dir for the label crops, output_root might be a network share
+                self.crop_dir = Path(tempfile.mkdtemp(prefix="stl_label_crops_"))
 
-            # 3. Save progress after each batch
-            self._save_checkpoint(checkpoint_path, checkpoint["completed"], all_failed)
+            # 2. One pool for the whole run, workers import pyvista/trimesh/skimage once (spawn) and pick up
+            # the next file as soon as they are free instead of waiting for the slowest file of a batch
+            try:
+                with ProcessPoolExecutor(max_workers=self.config.max_workers) as executor:
+                    self._stream_tasks(executor, all_tasks)
+            finally:
+                if self.crop_dir is not None:
+                    shutil.rmtree(self.crop_dir, ignore_errors=True)
+                for shm in self.shared_blocks.values(): # only left over if the run was aborted
+                    release_shared(shm)
+            self._adopt_archives()
+            print(f"\n{timing_summary(self.timings)}\n(per (file, label) in {self.timings_path})")
 
-        # 4. Final Metadata Export
-        if self.config.stl_metadata_path and stl_metadata:
+        # 3. Final Metadata Export, rebuilt from the manifest so labels that were up to date are included
+        self.stl_metadata = {}
+        for file_name, content_hash in self.file_hashes.items():
+            for name, meta in self.manifest.label_metadata(file_name, content_hash, self.label_hashes):
+                self.stl_metadata[name] = meta
+        if self.config.stl_metadata_path and self.stl_metadata:
             from utils.stl_metadata import save_metadata_to_json
-            save_metadata_to_json(stl_metadata, self.config.stl_metadata_path)
+            save_metadata_to_json(self.stl_metadata, self.config.stl_metadata_path)
 
         print(f"\n{'='*30}\nTotal execution time: {time.time() - start_time:.2f}s")
 
+    def _stream_tasks(self, executor: ProcessPoolExecutor, tasks: List[STLTask]) -> None:
+        """
+        Keep at most batch_size tasks queued in the pool and refill whenever one finishes.
+        With label granularity a finished split puts its label tasks at the front of the queue, and at most
+        one split per worker is queued or running, so the crops of a file are meshed (and deleted) before
+        more files are split.
+        """
+        self.pending = deque(tasks)
+        workers = self.config.max_workers or mp.cpu_count()
+        window = max(self.config.batch_size, workers)
+        budget = self.config.max_memory_gb
+        if budget:
+            # only as many tasks in the pool as workers, so everything admitted is really running
+            window = workers
+        in_flight = {}
+        reserved = {}  # future -> estimated GB
+        split_limit = workers if self.config.task_granularity == 'label' else None
+
+        if self.feed is not None:
+            # every fed labelmap waits in shared memory until its task is done, don't run too far ahead of the pool
+            window = min(window, 2 * workers)
+
+        def refill():
+            while len(in_flight) < window and (self.pending or self.feed is not None):
+                if not self.pending:
+                    self._feed_next()
+                    continue
+                if split_limit and isinstance(self.pending[0], STLTask) \
+                        and sum(isinstance(t, STLTask) for t in in_flight.values()) >= split_limit:
+                    return # the next split waits until a running one has handed out its label tasks
+                estimate = self._memory_estimate(self.pending[0]) if budget else 0.0
+                if budget and in_flight and sum(reserved.values()) + estimate > budget:
+                    return # wait for a running task to free its share
+                if budget and estimate > budget:
+                    print(f"Warning: {self._task_name(self.pending[0])} needs ~{estimate:.1f} GB, more than max_memory_gb={budget}, running it alone.")
+                task = self.pending.popleft()
+                future = self._submit(executor, task)
+                in_flight[future] = task
+                reserved[future] = estimate
+
+        refill()
+        while in_flight:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                reserved.pop(future, None)
+                self._on_task_done(in_flight.pop(future), future)
+            refill()
+
+    def _memory_estimate(self, task: Union[STLTask, STLLabelTask]) -> float:
+        """Estimated peak GB of a task, cached per file (header read once)."""
+        if isinstance(task, STLLabelTask):
+            # only the crop is loaded, its .npy size is the number of box voxels
+            try:
+                box_voxels = os.path.getsize(task.crop_file)
+            except OSError:
+                box_voxels = 0
+            return WORKER_BASE_GB + box_voxels * BYTES_PER_BOX_VOXEL / 1e9
+        key = task.input_file.name
+        if key not in self.memory_estimates and task.shared is not None:
+            self.memory_estimates[key] = estimate_labelmap_memory_gb(float(np.prod(task.shared.shape)), np.dtype(task.shared.dtype).itemsize,
+                                                                     label_work=self.config.task_granularity == 'file')
+        if key not in self.memory_estimates:
+            self.memory_estimates[key] = estimate_task_memory_gb(task.input_file, label_work=self.config.task_granularity == 'file')
+        return self.memory_estimates[key]
+
+    @staticmethod
+    def _task_name(task: Union[STLTask, STLLabelTask]) -> str:
+        if isinstance(task, STLLabelTask):
+            return f"{task.file_task.input_file.name} label {task.label}"
+        return task.input_file.name
+
+    def _submit(self, executor: ProcessPoolExecutor, task: Union[STLTask, STLLabelTask]):
+        if isinstance(task, STLLabelTask):
+            return executor.submit(self.process_label, task, self.config)
+        if self.config.task_granularity == 'label':
+            return executor.submit(self.split_file, task, self.config, self.crop_dir)
+        return executor.submit(self.process_file, task, self.config)
+
+    def _on_task_done(self, task: Union[STLTask, STLLabelTask], future) -> None:
+        """Completion callback in the main process, every finished file is checkpointed right away."""
+        try:
+            name, success, error, results, histogram, timings = future.result()
+        except Exception as e: # e.g. a worker killed by the OS, the pool reports it on the future
+            name = task.label if isinstance(task, STLLabelTask) else task.input_file.name
+            success, error, results, histogram, timings = False, str(e), {}, {}, []
+        self._record_timings(timings)
+        if isinstance(task, STLTask) and task.shared is not None:
+            # the worker copied the labelmap (or its label crops) out, the block is not needed anymore
+            release_shared(self.shared_blocks.pop(task.shared.name))
+        if histogram:
+            # cached for resumed runs and the analytics, valid as long as the labelmap hash is the same
+            self.manifest.record_histogram(task.input_file.name, task.content_hash, histogram)
+        voxel_count = sum(histogram.get(label, 0) for label in self.config.segment_params)
+
+        if isinstance(task, STLLabelTask):
+            self._on_label_done(task, success, error, results)
+        elif self.config.task_granularity == 'label' and success and results:
+            # file is split, its labels go to the front of the queue (in label order)
+            # labels that are not in the labelmap are done already, without an STL
+            label_results = {label: [] for label in task.selected_params(self.config.segment_params)}
+            for label_task in results:
+                del label_results[label_task.label]
+            self.label_jobs[name] = {"remaining": len(results), "errors": [], "results": label_results, "voxel_count": voxel_count}
+            if self.config.task_ordering == 'cost':
+                results = sorted(results, key=lambda t: t.voxel_count, reverse=True)
+            self.pending.extendleft(reversed(results))
+        elif self.config.task_granularity == 'label' and success:
+            # none of the labels are in the labelmap
+            self._finish_file(task, True, None, {label: [] for label in task.selected_params(self.config.segment_params)}, voxel_count)
+        else:
+            self._finish_file(task, success, error, results if success else {}, voxel_count)
+
+    def _record_timings(self, timings: List[dict]) -> None:
+        if timings:
+            self.timings.extend(timings)
+            append_timings(self.timings_path, timings)
+
+    def _on_label_done(self, task: STLLabelTask, success: bool, error: Optional[str], metadata_entries: list) -> None:
+        """Collect one label, the file counts as done once all of its labels are back."""
+        file_name = task.file_task.input_file.name
+        job = self.label_jobs[file_name]
+        job["remaining"] -= 1
+        if success:
+            job["results"][task.label] = metadata_entries
+        else:
+            job["errors"].append(f"label {task.label}: {error}")
+            print(f"✗ Failed: {file_name} label {task.label}")
+
+        if job["remaining"] == 0:
+            del self.label_jobs[file_name]
+            error = "; ".join(job["errors"]) or None
+            self._finish_file(task.file_task, error is None, error, job["results"], job["voxel_count"])
+
+    def _finish_file(self, task: STLTask, success: bool, error: Optional[str], label_results: Dict[int, list], voxel_count: int = 0) -> None:
+        """
+        Record the labels that were built (also those of a partly failed file, so they aren't rebuilt)
+        and checkpoint the file.
+        """
+        file_name = task.input_file.name
+        for label, metadata_entries in label_results.items():
+            self._record_label(file_name, label, task.content_hash, metadata_entries, task)
+
+        failed = [entry for entry in self.manifest.failed if entry["file"] != file_name]
+        if voxel_count:
+            self.manifest.costs[file_name] = voxel_count # cost hint for the ordering of the next run
+        if success:
+            if file_name not in self.manifest.completed:
+                self.manifest.completed.append(file_name)
+            print(f"✓ Completed: {file_name}" + (f" ({len(task.labels)} labels rebuilt)" if task.labels is not None else ""))
+        else:
+            failed.append({"file": file_name, "error": error})
+            print(f"✗ Failed: {file_name}")
+        self.manifest.failed = failed
+        self.manifest.save()
+
     @staticmethod
     def process_file(task: STLTask, config: STLProcessingConfig) -> tuple:
         """Process a single NIfTI file to STL, returning success status and metadata."""
         file_name = task.input_file.name
-        metadata_entries = []
+        label_results = {}  # label -> metadata entries, empty if the label is missing or smoothed away
+        timings = []
+        writer = shared_write_queue(config.write_threads, config.write_queue_size)
         try:
-            simple_name = task.input_file.stem.split('.')[0]
-            nii_img = nib.load(str(task.input_file))
-            nii_data = nii_img.get_fdata()
-            affine = nii_img.affine
-            
-            for label, params in config.segment_params.items():
-                # Extract Binary Segment
-                binary_segment = (nii_data == int(label))
-                if np.sum(binary_segment) == 0:
-                    binary_segment = (np.round(nii_data).astype(int) == int(label))
-                
-                if np.sum(binary_segment) == 0:
+            simple_name = task.metadata_name or task.input_file.stem.split('.')[0]
+            timer = StageTimer()
+            with timer.stage("load"):
+                label_image, affine = ParallelSTLProcessor.load_task_labelmap(task)
+            segment_params = task.selected_params(config.segment_params)
+
+            # One scan for all labels instead of a full volume comparison per label
+            with timer.stage("histogram"):
+                histogram = label_histogram(label_image)
+            with timer.stage("extraction"):
+                regions = extract_label_regions(label_image, segment_params.keys(), histogram)
+            timings.append(timer.record(file=file_name, label=None))
+
+            label_records = []  # recorded once the writes are done, they add the "write" stage
+            for label, params in segment_params.items():
+                label_results[label] = []
+                region = regions.get(int(label))
+                if region is None:
                     continue
 
-                if config.fill_holes > 0:
-                    binary_segment = fill_holes_3d(binary_segment) # Helper function, works ok should be tunred off by default 
+                timer = StageTimer()
+                # Extract Binary Segment inside a padded box, big enough that smoothing and meshing match the full volume
+                with timer.stage("crop"):
+                    binary_segment, offset = region.padded_crop(label_image, smoothing_padding(params.volume_smoothing))
 
-                # Volume Smoothing
-                smoothed = ndimage.gaussian_filter(binary_segment.astype(float), sigma=params.volume_smoothing)
-                binary_smooth = smoothed > 0.5
-                
-                if np.sum(binary_smooth) == 0: continue
+                mesh_data = ParallelSTLProcessor.mesh_label(binary_segment, offset, affine, params, config, timer)
+                record = dict(file=file_name, label=int(label), label_name=params.label_name, voxels=region.voxel_count)
+                if mesh_data is not None:
+                    metadata_entry, record["write_queue"] = ParallelSTLProcessor.export_label(*mesh_data, simple_name, task, params, config, timer, writer)
+                    label_results[label].append(metadata_entry)
+                label_records.append((timer, record))
 
-                # Marching Cubes
+            writer.drain()
+            timings.extend(timer.record(**record) for timer, record in label_records)
+            return (file_name, True, None, label_results, histogram, timings)
+        except Exception as e:
+            writer.drain(raise_errors=False) # don't leave this file's writes to the next task
+            return (file_name, False, str(e), {}, {}, timings)
+
+    @staticmethod
+    def load_task_labelmap(task: STLTask) -> Tuple[np.ndarray, np.ndarray]:
+        """(labelmap, affine) from shared memory if the task has it, else from the NIfTI file."""
+        if task.shared is not None:
+            return load_shared_labelmap(task.shared)
+        label_image, nii_img = load_labelmap(task.input_file) # integer dtype as on disk, no float64 copy
+        return label_image, nii_img.affine
+
+    @staticmethod
+    def mesh_label(binary_segment: np.ndarray, offset: np.ndarray, affine: np.ndarray, params: LabelConfig,
+                   config: STLProcessingConfig, timer: Optional[StageTimer] = None) -> Optional[Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+        """
+        Padded label crop to a smoothed and repaired mesh in LPS world coordinates, None if smoothing removed it.
+        Returns (verts, faces, marching cubes resolution in mm per voxel axis).
+        """
+        timer = timer or StageTimer()
+        if config.fill_holes > 0:
+            with timer.stage("fill_holes"):
+                binary_segment = fill_holes_3d(binary_segment, mode=config.fill_holes_mode, max_workers=config.fill_holes_threads) # Helper function, works ok should be tunred off by default 
+
+        # Volume Smoothing
+        with timer.stage("gaussian"):
+            smoothed = ndimage.gaussian_filter(binary_segment.astype(float), sigma=params.volume_smoothing)
+            binary_smooth = smoothed > 0.5
+        
+        if np.sum(binary_smooth) == 0: return None
+
+        # Marching Cubes
+        steps = marching_cubes_steps(params, affine)
+        coarse_grid = smoothed[tuple(slice(None, None, step) for step in steps)]
+        if (steps == 1).all() or min(coarse_grid.shape) < 2:
+            steps = np.ones(3, dtype=int)
+            coarse_grid = None
+        with timer.stage("marching_cubes"):
+            if coarse_grid is None:
                 verts, faces, _, _ = measure.marching_cubes(binary_smooth, level=0.5)
+            else:
+                # every steps-th sample of the smoothed field, the float field keeps the coarse surface smooth where the subsampled mask would be blocky.
+                # The crop padding can be smaller than a step, so the last sample may still be inside the label: one background
+                # sample around the grid closes the surface there (the field beyond the crop is background anyway)
+                verts, faces, _, _ = measure.marching_cubes(np.pad(coarse_grid, 1), level=0.5)
+                verts = (verts - 1) * steps # coarse grid index to crop voxel index
+            verts += offset # back from the crop to voxel coordinates of the full image
+
+            # Voxel to World + LPS Conversion
+            verts = np.hstack([verts, np.ones((verts.shape[0], 1))])
+            verts = (affine @ verts.T).T[:, :3]
+            verts = convert_to_LPS(verts) # Helper function to get coordinate system right 
+
+        # Mesh Smoothing
+        m_cfg = params.mesh_config
+        if m_cfg.iterations > 0:
+            with timer.stage("smoothing"):
+                verts = smooth_mesh_pyvista(verts, faces, method=m_cfg.method, 
+                                           n_iter=m_cfg.iterations, relaxation_factor=m_cfg.factor, backend=config.smoothing_backend)
+
+        # Decimation, before the repair so pymeshfix and the second smoothing work on the smaller mesh
+        if params.decimation is not None:
+            with timer.stage("decimation"):
+                verts, faces = decimate_mesh_pyvista(verts, faces, params.decimation)
+
+        # Pymeshfix Repair
+        if config.use_pymeshfix:
+            with timer.stage("pymeshfix"):
+                meshfix = pymeshfix.MeshFix(verts, faces)
+                meshfix.repair(remove_smallest_components=config.remove_islands)
+                verts, faces = meshfix.points, meshfix.faces
             
-                # Voxel to World + LPS Conversion
-                verts = np.hstack([verts, np.ones((verts.shape[0], 1))])
-                verts = (affine @ verts.T).T[:, :3]
-                verts = convert_to_LPS(verts) # Helper function to get coordinate system right 
-
-                # Mesh Smoothing
-                m_cfg = params.mesh_config
-                if m_cfg.iterations > 0:
-                    verts = smooth_mesh_pyvista(verts, faces, method=m_cfg.method, 
-                                               n_iter=m_cfg.iterations, relaxation_factor=m_cfg.factor)
-
-                # Pymeshfix Repair
-                if config.use_pymeshfix:
-                    meshfix = pymeshfix.MeshFix(verts, faces)
-                    meshfix.repair(remove_smallest_components=config.remove_islands)
-                    verts, faces = meshfix.points, meshfix.faces
-                    
-                    t_mesh = trimesh.Trimesh(vertices=verts, faces=faces, process=False)
-                    trimesh.repair.fix_inversion(t_mesh)
-                    verts, faces = t_mesh.vertices, t_mesh.faces
-                    
-                    # Post-repair polish
-                    verts = smooth_mesh_pyvista(verts, faces, method=m_cfg.method, n_iter=50, relaxation_factor=0.1)
-                    
-                    
-                #debug_normals(verts, faces)   
-
-                # Export STL
-                from utils.stl_metadata import calculate_volume_and_surface_area
-                vol, surf = calculate_volume_and_surface_area(verts, faces)
-                metadata_entries.append((f"{simple_name}_{params.label_name}", {"Mesh_volume_mm3": vol, "Surface_Area_mm2": surf}))
-
-                stl_mesh = mesh.Mesh(np.zeros(faces.shape[0], dtype=mesh.Mesh.dtype))
-                for i, face in enumerate(faces):
-                    for j in range(3):
-                        stl_mesh.vectors[i][j] = verts[face[j]]
-                
-                out_name = f"{params.label_name}_{task.file_number}.stl"
-                stl_mesh.save(task.output_dir / out_name)
+            with timer.stage("fix_inversion"):
+                t_mesh = trimesh.Trimesh(vertices=verts, faces=faces, process=False)
+                trimesh.repair.fix_inversion(t_mesh)
+                verts, faces = t_mesh.vertices, t_mesh.faces
+            
+            # Post-repair polish
+            with timer.stage("post_smoothing"):
+                verts = smooth_mesh_pyvista(verts, faces, method=m_cfg.method, n_iter=50, relaxation_factor=0.1, backend=config.smoothing_backend)
             
-            return (file_name, True, None, metadata_entries)
+            
+        #debug_normals(verts, faces)   
+        resolution_mm = steps * np.linalg.norm(np.asarray(affine)[:3, :3], axis=0)
+        return verts, faces, resolution_mm
+
+    @staticmethod
+    def export_label(verts: np.ndarray, faces: np.ndarray, resolution_mm: np.ndarray, simple_name: str, task: STLTask,
+                     params: LabelConfig, config: STLProcessingConfig, timer: Optional[StageTimer] = None,
+                     writer: Optional[WriteBehindQueue] = None) -> Tuple[Tuple[str, Dict[str, Any]], dict]:
+        """
+        Queue the mesh of one label (STL or config.output_format) on the writer and return its metadata entry
+        and the queue stats of the write. The file only exists after writer.drain().
+        """
+        from utils.stl_metadata import calculate_volume_and_surface_area
+        timer = timer or StageTimer()
+        writer = writer or WriteBehindQueue(max_workers=0)
+        # verts and faces are not touched after this, so the writer thread can use them as they are
+        write_stats = writer.submit(write_mesh, ParallelSTLProcessor.output_path(task, params, config.output_format), verts, faces,
+                                    config.output_format, config.stl_writer, timer=timer)
+        with timer.stage("metrics"):
+            vol, surf = calculate_volume_and_surface_area(verts, faces)
+
+        metadata_entry = (f"{simple_name}_{params.label_name}", {"Mesh_volume_mm3": vol, "Surface_Area_mm2": surf,
+                                                                 "Mesh_resolution_mm": [round(float(r), 4) for r in resolution_mm]})
+        return metadata_entry, write_stats
+
+    @staticmethod
+    def output_path(task: STLTask, params: LabelConfig, output_format: MeshFormat = 'stl') -> Path:
+        return task.output_dir / f"{task.file_prefix}{params.label_name}_{task.file_number}.{output_format}"
+
+    @staticmethod
+    def split_file(task: STLTask, config: STLProcessingConfig, crop_dir: Path) -> tuple:
+        """
+        Label granularity, first step: load the labelmap once and save every label's padded crop as .npy in crop_dir.
+        Returns (file_name, success, error, label_tasks), the label tasks go back into the pool.
+        """
+        file_name = task.input_file.name
+        timer = StageTimer()
+        try:
+            with timer.stage("load"):
+                label_image, affine = ParallelSTLProcessor.load_task_labelmap(task)
+            affine = np.asarray(affine).tolist()
+            segment_params = task.selected_params(config.segment_params)
+            with timer.stage("histogram"):
+                histogram = label_histogram(label_image)
+            with timer.stage("extraction"):
+                regions = extract_label_regions(label_image, segment_params.keys(), histogram)
+
+            label_tasks = []
+            with timer.stage("save_crops"):
+                for label, params in segment_params.items():
+                    region = regions.get(int(label))
+                    if region is None:
+                        continue
+                    binary_segment, offset = region.padded_crop(label_image, smoothing_padding(params.volume_smoothing))
+                    crop_file = crop_dir / f"{task.input_file.stem.split('.')[0]}_{int(label)}.npy"
+                    np.save(crop_file, binary_segment)
+                    label_tasks.append(STLLabelTask(file_task=task, label=int(label), crop_file=crop_file,
+                                                    offset=offset.tolist(), affine=affine, voxel_count=region.voxel_count))
+            timings = [timer.record(file=file_name, label=None)]
+            return (file_name, True, None, label_tasks, histogram, timings)
+        except Exception as e:
+            return (file_name, False, str(e), [], {}, [timer.record(file=file_name, label=None)])
+
+    @staticmethod
+    def process_label(task: STLLabelTask, config: STLProcessingConfig) -> tuple:
+        """Label granularity, second step: mesh one label from its memory-mapped crop."""
+        timer = StageTimer()
+        params = config.segment_params[task.label]
+        record = dict(file=task.file_task.input_file.name, label=task.label, label_name=params.label_name, voxels=task.voxel_count)
+        writer = shared_write_queue(config.write_threads, config.write_queue_size)
+        try:
+            with timer.stage("load_crop"):
+                crop = np.load(task.crop_file, mmap_mode='r')
+                binary_segment = np.array(crop) # into memory, the memmap has to be closed before the file can be removed on Windows
+                del crop
+            mesh_data = ParallelSTLProcessor.mesh_label(binary_segment, np.asarray(task.offset), np.asarray(task.affine), params, config, timer)
+            metadata_entries = []
+            if mesh_data is not None:
+                simple_name = task.file_task.metadata_name or task.file_task.input_file.stem.split('.')[0]
+                # one label per task, only the metrics overlap with the write here
+                metadata_entry, record["write_queue"] = ParallelSTLProcessor.export_label(*mesh_data, simple_name, task.file_task, params, config, timer, writer)
+                metadata_entries.append(metadata_entry)
+            writer.drain()
+            return (task.label, True, None, metadata_entries, {}, [timer.record(**record)])
         except Exception as e:
-            return (file_name, False, str(e), [])
+            writer.drain(raise_errors=False)
+            return (task.label, False, str(e), [], {}, [timer.record(**record)])
+        finally:
+            try:
+                os.remove(task.crop_file)
+            except OSError:
+                pass
 
-    def _prepare_tasks(self, completed_list) -> List[STLTask]:
+    def _prepare_tasks(self) -> List[STLTask]:
+        """
+        One task per labelmap with labels to (re)build. A label is up to date if the labelmap content,
+        its parameters and its STL are unchanged since it was built, only the other labels are redone.
+        """
         tasks = []
-        completed_set = set(completed_list)
+        completed, rebuilt_labels = [], 0
         for f_name in sorted(os.listdir(self.config.input_dir)):
-            if f_name.endswith(".nii.gz") and f_name not in completed_set:
-                input_path = self.config.input_dir / f_name
-                file_num = f_name.split('_')[1].split('.')[0].split("-")[0]   #we have e.g. Ank_001-rechts.nii.gz so [0] is the number [1] the side 
-                
-                out_dir = self.config.output_root / f"STL{file_num}"
-                if self.config.split and "-" in f_name:
-                    side = f_name.split('_')[1].split('.')[0].split("-")[1]
-                    out_dir = Path(str(out_dir) + f"_{side}")
-                
-                out_dir.mkdir(parents=True, exist_ok=True)
-                tasks.append(STLTask(input_file=input_path, output_dir=out_dir, file_number=file_num))
+            if f_name.endswith(".nii.gz"):
+                task = self._prepare_task(f_name)
+                if task is None:
+                    completed.append(f_name)
+                    continue
+                rebuilt_labels += len(task.labels) if task.labels is not None else len(self.label_hashes)
+                tasks.append(task)
+
+        self.manifest.completed = completed
+        if completed:
+            print(f"{len(completed)} files up to date, {rebuilt_labels} labels in {len(tasks)} files to (re)build.")
         return tasks
 
-    def _load_checkpoint(self, path):
-        if self.config.resume and path.exists():
-            return json.loads(path.read_text())
-        return {"completed": [], "failed": []}
+    def _prepare_task(self, f_name: str, content_hash: Optional[str] = None) -> Optional[STLTask]:
+        """Task for one labelmap in input_dir, None if all of its labels are up to date. content_hash skips hashing the file."""
+        input_path = self.config.input_dir / f_name
+        file_num = f_name.split('_')[1].split('.')[0].split("-")[0]   #we have e.g. Ank_001-rechts.nii.gz so [0] is the number [1] the side 
+        
+        out_dir = self.config.output_root / f"STL{file_num}"
+        if self.config.split and "-" in f_name:
+            side = f_name.split('_')[1].split('.')[0].split("-")[1]
+            out_dir = Path(str(out_dir) + f"_{side}")
+
+        task = STLTask(input_file=input_path, output_dir=out_dir, file_number=file_num)
+        if self.config.file_mapping is not None:
+            task = self._apply_original_name(task, f_name)
+
+        content_hash = content_hash or self.manifest.content_hash(input_path)
+        task.content_hash = content_hash
+        self.file_hashes[f_name] = content_hash
+        # the expected file names are part of up to date, they change with the naming (decoder.json)
+        expected = {label: self.output_path(task, params, self.config.output_format).relative_to(self.config.output_root).as_posix()
+                    for label, params in self.config.segment_params.items()}
+        stale = self.manifest.stale_labels(f_name, content_hash, self.label_hashes, self.config.output_root, expected)
+        histogram = self.manifest.histogram(f_name, content_hash)
+        if histogram is not None and stale:
+            # labels the cached histogram says are empty are done without loading the labelmap
+            empty = [label for label in stale if histogram.get(label, 0) == 0]
+            for label in empty:
+                self._record_label(f_name, label, content_hash, [], None)
+            stale = [label for label in stale if label not in empty]
+        if not stale:
+            return None
+        
+        task.output_dir.mkdir(parents=True, exist_ok=True)
+        task.labels = None if len(stale) == len(self.label_hashes) else stale
+        return task
+
+    def _feed_next(self) -> None:
+        """Pull the next labelmap from the feed into pending, the feed is None once it is used up."""
+        item = next(self.feed, None)
+        if item is None:
+            self.feed = None
+            return
+        if isinstance(item, InMemoryLabelmap):
+            # nothing on disk to hash (yet), the labels are keyed by a one-off id until the archived NIfTI is adopted
+            source = f"memory:{uuid.uuid4().hex}"
+            task = self._prepare_task(item.file_name, content_hash=source)
+            shm, task.shared = share_labelmap(item.array, item.affine)
+            self.shared_blocks[shm.name] = shm
+            if item.archive is not None:
+                self.archives.append((item.file_name, source, item.archive))
+        else:
+            task = self._prepare_task(Path(item).name)
+            if task is None:
+                self.manifest.completed.append(Path(item).name)
+                print(f"✓ Up to date: {Path(item).name}")
+                return
+        self.pending.append(task)
+
+    def _adopt_archives(self) -> None:
+        """
+        Once the NIfTI of an in-memory labelmap is written, key its labels by the file's content hash,
+        so the next run from disk sees them as up to date.
+        """
+        for file_name, source, archive in self.archives:
+            try:
+                archive.result()
+                content_hash = self.manifest.content_hash(self.config.input_dir / file_name)
+            except Exception as e:
+                print(f"Warning: labelmap {file_name} was not archived ({e}), its STLs will be rebuilt next run.")
+                continue
+            self.manifest.rebase_source(file_name, source, content_hash)
+            self.file_hashes[file_name] = content_hash
+        self.archives = []
+        self.manifest.save()
+
+    def _apply_original_name(self, task: STLTask, f_name: str) -> STLTask:
+        """
+        Folder, file and metadata names as stl_renamer_with_lut and rename_keys would leave them,
+        e.g. STL001_rechts/A_001.stl -> Patient01_rechts/Patient01_A_001.stl and key Patient01_RECHTS_A.
+        """
+        lookup = {info["number"]: original_name for original_name, info in self.config.file_mapping.items()}
+        number = f_name.split('_')[1].split('.')[0]
+        side = f"_{number.split('-')[1].upper()}" if "-" in number else ""
+        original_name = lookup.get(task.file_number)
+        if original_name is None:
+            # the renamer leaves folder and files alone, rename_keys still drops the prefix
+            return task.model_copy(update={"metadata_name": task.file_number + side})
+        original_name = original_name.replace(".nii.gz", "")
+        output_dir = task.output_dir.with_name(original_name + task.output_dir.name[len(f"STL{task.file_number}"):])
+        return task.model_copy(update={"output_dir": output_dir, "file_prefix": f"{original_name}_",
+                                       "metadata_name": original_name.split('.')[0] + side})
+
+    def _record_label(self, file_name: str, label: int, content_hash: str, metadata_entries: list, task: Optional[STLTask]) -> None:
+        params = self.config.segment_params[label]
+        outputs = [self.output_path(task, params, self.config.output_format).relative_to(self.config.output_root).as_posix()] if metadata_entries else []
+        orphaned = self.manifest.record_label(file_name, label, content_hash, self.label_hashes[label],
+                                              outputs, [list(entry) for entry in metadata_entries])
+        for output in orphaned: # e.g. the label is gone from a re-predicted labelmap, don't leave the old STL behind
+            (self.config.output_root / output).unlink(missing_ok=True)
+
+    def label_histograms(self) -> Dict[str, Dict[int, int]]:
+        """Cached label voxel counts of the labelmaps of the last run, e.g. for calculate_hu_stats."""
+        histograms = {}
+        for file_name, content_hash in getattr(self, "file_hashes", {}).items():
+            histogram = self.manifest.histogram(file_name, content_hash)
+            if histogram is not None:
+                histograms[file_name] = histogram
+        return histograms
+
+    def _order_tasks(self, tasks: List[STLTask]) -> List[STLTask]:
+        """
+        Longest first (LPT), so the big scans don't end up as the long tail of a run.
+        Uses the labelled voxels of a previous run if every file has one, otherwise the header shape (or file size).
+        """
+        if self.config.task_ordering == 'name' or len(tasks) < 2:
+            return tasks
+
+        previous = self.manifest.costs
+        if all(task.input_file.name in previous for task in tasks):
+            source, costs = "labelled voxels of the previous run", {task.input_file.name: previous[task.input_file.name] for task in tasks}
+        else:
+            source, costs = "header shape", {task.input_file.name: estimate_file_cost(task.input_file) for task in tasks}
 
-    def _save_checkpoint(self, path, completed, failed):
-        path.write_text(json.dumps({"completed": completed, "failed": failed}, indent=2))
+        ordered = sorted(tasks, key=lambda t: costs[t.input_file.name], reverse=True) # stable, ties stay alphabetical
+        preview = ", ".join(f"{t.input_file.name} ({costs[t.input_file.name] / 1e6:.1f}M)" for t in ordered[:5])
+        print(f"Task order: largest first by {source}: {preview}{', ...' if len(ordered) > 5 else ''}")
+        return ordered
 
 
 
@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+import trimesh
+
+from multi_stl import LabelConfig, MeshSmoothingConfig, ParallelSTLProcessor, STLProcessingConfig, smoothing_padding
+
+SPACING = 0.5  # mm
+SIGMA = 0.5
+
+
+def mesh_cube(tmp_path, size_mm: float, step: int):
+    """Cube label cropped the way the workers crop it (label box + smoothing padding), meshed on every step-th voxel."""
+    n = int(round(size_mm / SPACING))
+    pad = smoothing_padding(SIGMA)
+    crop = np.zeros((n + 2 * pad,) * 3, dtype=bool)
+    crop[pad:pad + n, pad:pad + n, pad:pad + n] = True
+    params = LabelConfig(label_name="cube", volume_smoothing=SIGMA, mesh_resolution_mm=step * SPACING,
+                         mesh_config=MeshSmoothingConfig(iterations=0))
+    config = STLProcessingConfig(input_dir=tmp_path, output_root=tmp_path, segment_params={1: params}, use_pymeshfix=False)
+    affine = np.diag([SPACING, SPACING, SPACING, 1.0])
+    verts, faces, _ = ParallelSTLProcessor.mesh_label(crop, np.zeros(3), affine, params, config)
+    return trimesh.Trimesh(vertices=verts, faces=faces, process=True)
+
+
+@pytest.mark.parametrize("step", [4, 6, 8])
+@pytest.mark.parametrize("size_mm", [10.0, 12.5, 15.0, 17.5, 20.0])
+def test_coarse_cube_is_closed_and_keeps_extent(tmp_path, size_mm, step):
+    mesh = mesh_cube(tmp_path, size_mm, step)
+    assert mesh.is_watertight
+    extent = mesh.bounds[1] - mesh.bounds[0]
+    assert np.all(np.abs(extent - size_mm) <= step * SPACING)
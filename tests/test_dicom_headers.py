@@ -0,0 +1,46 @@
+import struct
+
+from pydicom.dataset import FileDataset, FileMetaDataset
+from pydicom.uid import CTImageStorage, ExplicitVRLittleEndian, generate_uid
+
+from utils import dicom_headers
+from utils.dicom_headers import read_header, read_header_fast, read_header_pydicom
+
+
+def write_dicom(path, **tags) -> bytes:
+    """Explicit VR little endian file with the given tags, returns its bytes."""
+    meta = FileMetaDataset()
+    meta.MediaStorageSOPClassUID = CTImageStorage
+    meta.MediaStorageSOPInstanceUID = generate_uid()
+    meta.TransferSyntaxUID = ExplicitVRLittleEndian
+    ds = FileDataset(str(path), {}, file_meta=meta, preamble=b"\0" * 128)
+    ds.SOPClassUID = CTImageStorage
+    ds.SOPInstanceUID = meta.MediaStorageSOPInstanceUID
+    for keyword, value in tags.items():
+        setattr(ds, keyword, value)
+    ds.save_as(path, enforce_file_format=True)
+    return path.read_bytes()
+
+
+def as_un(data: bytes, group: int, element: int, vr: bytes) -> bytes:
+    """Re-encode one short-VR element as UN, pydicom itself always writes the dictionary VR."""
+    start = data.index(struct.pack("<HH", group, element) + vr)
+    length = struct.unpack_from("<H", data, start + 6)[0]
+    value = data[start + 8:start + 8 + length]
+    return data[:start] + struct.pack("<HH2sHI", group, element, b"UN", 0, length) + value + data[start + 8 + length:]
+
+
+def test_un_elements_stay_on_the_fast_path(tmp_path, monkeypatch):
+    path = tmp_path / "un.dcm"
+    data = write_dicom(path, PatientID="P1", PatientName="Doe^Jane", SeriesDescription="Bone 0.6", SeriesNumber=3)
+    path.write_bytes(as_un(data, 0x0008, 0x103E, b"LO"))  # pydicom converts UN back with the dictionary VR
+
+    header = read_header_fast(path)
+    assert header is not None
+    assert header == read_header_pydicom(path)
+    assert header.series_description == "Bone 0.6"
+
+    def no_fallback(p):
+        raise AssertionError(f"pydicom fallback for {p}")
+    monkeypatch.setattr(dicom_headers, "read_header_pydicom", no_fallback)
+    assert read_header(path) == header
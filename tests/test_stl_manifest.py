@@ -0,0 +1,50 @@
+import nibabel as nib
+import numpy as np
+
+from multi_stl import LabelConfig, MeshSmoothingConfig, ParallelSTLProcessor, STLProcessingConfig
+
+
+def write_labelmap(input_dir, labels):
+    """Ank_001.nii.gz with a 6 voxel cube for every label, next to each other along x."""
+    data = np.zeros((10 * max(labels) + 4, 12, 12), dtype=np.uint8)
+    for label in labels:
+        data[10 * label - 6:10 * label, 3:9, 3:9] = label
+    nib.save(nib.Nifti1Image(data, np.eye(4)), str(input_dir / "Ank_001.nii.gz"))
+
+
+def run(tmp_path, segment_params):
+    config = STLProcessingConfig(input_dir=tmp_path / "labels", output_root=tmp_path / "stl", segment_params=segment_params,
+                                 max_workers=1, stl_metadata_path=tmp_path / "stl_metadata.json", use_pymeshfix=False)
+    ParallelSTLProcessor(config).run()
+    return {path.name: path.stat().st_mtime_ns for path in (tmp_path / "stl").rglob("*.stl")}
+
+
+def label_params(smoothing_b=0.5):
+    return {1: LabelConfig(label_name="A", volume_smoothing=0.5, mesh_config=MeshSmoothingConfig(iterations=0)),
+            2: LabelConfig(label_name="B", volume_smoothing=smoothing_b, mesh_config=MeshSmoothingConfig(iterations=0))}
+
+
+def first_run(tmp_path):
+    (tmp_path / "labels").mkdir()
+    write_labelmap(tmp_path / "labels", [1, 2])
+    built = run(tmp_path, label_params())
+    assert set(built) == {"A_001.stl", "B_001.stl"}
+    return built
+
+
+def test_unchanged_rerun_skips_everything(tmp_path):
+    first = first_run(tmp_path)
+    assert run(tmp_path, label_params()) == first
+
+
+def test_changed_params_rebuild_only_that_label(tmp_path):
+    first = first_run(tmp_path)
+    second = run(tmp_path, label_params(smoothing_b=1.0))
+    assert second["A_001.stl"] == first["A_001.stl"]
+    assert second["B_001.stl"] != first["B_001.stl"]
+
+
+def test_label_gone_from_labelmap_removes_its_stl(tmp_path):
+    first_run(tmp_path)
+    write_labelmap(tmp_path / "labels", [1])  # re-predicted without B
+    assert set(run(tmp_path, label_params())) == {"A_001.stl"}
@@ -8,26 +8,30 @@ import numpy as np
 import pandas as pd
 from scipy import stats
 
-def process_single_hu_mask_pair(hu_nii_path, labelmap_path, original_subject_filename, labels_dict, task_id):
+from utils.labelmap_io import load_labelmap, label_histogram
+
+def process_single_hu_mask_pair(hu_nii_path, labelmap_path, original_subject_filename, labels_dict, task_id, label_counts=None):
     """
     Processes a single image/mask pair and calculates HU statistics.
+    label_counts is the cached label histogram of the mask (from the STL run), if not given it is computed here.
     """
     results_list = []
     
     try:
         hu_img = nib.load(hu_nii_path)
-        mask_img = nib.load(labelmap_path)
         
-        # Using get_fdata() is fine, but for large volumes, ensure memory is available
+        # Using get_fdata() is fine for the HU image, but for large volumes, ensure memory is available
         hu_data = hu_img.get_fdata()
-        mask_data = mask_img.get_fdata()
+        # The mask stays in its integer dtype, no float64 copy
+        mask_data, _ = load_labelmap(labelmap_path)
         
         if hu_data.shape != mask_data.shape:
             raise ValueError(f"Shape mismatch: HU {hu_data.shape} vs Mask {mask_data.shape}")
 
         voxel_volume = np.prod(hu_img.header.get_zooms()[:3])
-        unique_labels = np.unique(mask_data).astype(int)
-        unique_labels = unique_labels[unique_labels != 0]
+        if label_counts is None:
+            label_counts = label_histogram(mask_data)  # one bincount instead of sorting the volume with np.unique
+        unique_labels = sorted(label for label, count in label_counts.items() if count > 0)
 
         for label in unique_labels:
             roi_hu_values = hu_data[mask_data == label]
@@ -60,7 +64,7 @@ def process_single_hu_mask_pair(hu_nii_path, labelmap_path, original_subject_fil
     return results_list
 
 def calculate_hu_stats(inference_path, labelmap_output_path, file_mapping, output_directory, 
-                       max_workers=8, task_id=None, labels_dict=None, stl_metadata_path=None):
+                       max_workers=8, task_id=None, labels_dict=None, stl_metadata_path=None, label_histograms=None):
 
     output_directory = Path(output_directory)
     output_directory.mkdir(exist_ok=True, parents=True)
@@ -104,7 +108,8 @@ def calculate_hu_stats(inference_path, labelmap_output_path, file_mapping, outpu
             
             if hu_nii_path.exists():
                 tasks_to_run.append((
-                    hu_nii_path, labelmap_path, subject_display_name, labels_dict, task_id
+                    hu_nii_path, labelmap_path, subject_display_name, labels_dict, task_id,
+                    (label_histograms or {}).get(labelmap_filename)
                 ))
             else:
                 print(f"Warning: HU file {hu_nii_filename} not found.")
@@ -0,0 +1,234 @@
+import os
+import struct
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+import pydicom
+from pydicom.charset import convert_encodings
+from pydicom.dataelem import RawDataElement, convert_raw_data_element
+from pydicom.tag import Tag
+from pydicom.uid import UID
+
+PathLike = Union[str, Path]
+
+# The only tags the sorting needs
+NEEDED_TAGS = ["PatientID", "PatientName", "StudyDescription", "SeriesDescription", "SeriesNumber"]
+
+
+@dataclass(frozen=True)
+class DicomHeader:
+    """The sorting tags of one file as strings, missing tags get the same defaults DICOM_splitter always used."""
+    patient_id: str = "UnknownID"
+    patient_name: str = "UnknownName"
+    study_description: str = "unknownStudy"
+    series_description: str = "UnknownSeries"
+    series_number: str = "0"
+
+
+def walk_entries(root: PathLike) -> Iterator[os.DirEntry]:
+    """All files below root as scandir entries, they carry the stat (free on Windows) instead of a stat per path like rglob + is_file."""
+    stack = [os.fspath(root)]
+    while stack:
+        directory = stack.pop()
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file():
+                        yield entry
+        except OSError as e:
+            print(f"Could not list {directory}: {e}")
+
+
+def walk_files(root: PathLike) -> Iterator[str]:
+    """All file paths below root."""
+    return (entry.path for entry in walk_entries(root))
+
+
+def read_header_pydicom(path: PathLike) -> DicomHeader:
+    """Sorting tags of one file with pydicom, parsing stops before the pixel data."""
+    dcm = pydicom.dcmread(path, stop_before_pixels=True, force=True, specific_tags=NEEDED_TAGS)
+    return DicomHeader(
+        patient_id=str(getattr(dcm, "PatientID", "UnknownID")),
+        patient_name=str(getattr(dcm, "PatientName", "UnknownName")),
+        study_description=str(getattr(dcm, "StudyDescription", "unknownStudy")),
+        series_description=str(getattr(dcm, "SeriesDescription", "UnknownSeries")),
+        series_number=str(getattr(dcm, "SeriesNumber", 0)),
+    )
+
+
+def read_headers(paths: Iterable[str], max_workers: int = 32) -> Iterator[Tuple[str, Union[DicomHeader, Exception]]]:
+    """
+    (path, header) for every path, an exception instead of the header if the file could not be read.
+    The paths feed a thread pool while they are still coming in (e.g. from a running walk), at most a few reads
+    per thread are queued, so the first headers are parsed before the whole tree is listed and memory stays flat
+    for huge exports. Results come in completion order.
+    """
+    max_queued = max_workers * 4
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        in_flight = {}
+
+        def collect(futures) -> List[Tuple[str, Union[DicomHeader, Exception]]]:
+            results = []
+            for future in futures:
+                path = in_flight.pop(future)
+                try:
+                    results.append((path, future.result()))
+                except Exception as e:
+                    results.append((path, e))
+            return results
+
+        for path in paths:
+            in_flight[executor.submit(read_header, path)] = path
+            if len(in_flight) >= max_queued:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                yield from collect(done)
+        yield from collect(list(in_flight))
+
+
+def scan_headers(root: PathLike, max_workers: int = 32) -> Iterator[Tuple[str, Union[DicomHeader, Exception]]]:
+    """(path, header) for every file below root, read while the walk is still running. See read_headers."""
+    return read_headers(walk_files(root), max_workers=max_workers)
+
+
+# Byte-prefix reader: the sorting tags all sit in groups 0008-0020 near the start of the file
+SPECIFIC_CHARACTER_SET = 0x00080005
+HEADER_TAGS = {
+    0x00100020: ("patient_id", "UnknownID"),
+    0x00100010: ("patient_name", "UnknownName"),
+    0x00081030: ("study_description", "unknownStudy"),
+    0x0008103E: ("series_description", "UnknownSeries"),
+    0x00200011: ("series_number", 0),
+}
+LAST_TAG = max(HEADER_TAGS)  # SeriesNumber, parsing stops at the first tag after it
+PREFIX_SIZES = (4096, 16384, 65536)  # bytes read per attempt, beyond that pydicom takes over
+UNDEFINED_LENGTH = 0xFFFFFFFF
+ITEM, ITEM_END, SEQUENCE_END = 0xFFFEE000, 0xFFFEE00D, 0xFFFEE0DD
+LONG_LENGTH_VRS = {b"OB", b"OD", b"OF", b"OL", b"OV", b"OW", b"SQ", b"SV", b"UC", b"UN", b"UR", b"UT", b"UV"}
+
+
+class _Truncated(Exception):
+    """The prefix ended before the last needed tag."""
+
+
+def _element_header(buf: bytes, pos: int, explicit: bool) -> Tuple[int, Optional[bytes], int, int]:
+    """(tag, VR or None, length, offset of the value) of the data element at pos, little endian."""
+    if pos + 8 > len(buf):
+        raise _Truncated
+    group, element = struct.unpack_from("<HH", buf, pos)
+    tag = group << 16 | element
+    if not explicit or group == 0xFFFE:  # items and delimiters never have a VR
+        return tag, None, struct.unpack_from("<I", buf, pos + 4)[0], pos + 8
+    vr = buf[pos + 4:pos + 6]
+    if vr in LONG_LENGTH_VRS:
+        if pos + 12 > len(buf):
+            raise _Truncated
+        return tag, vr, struct.unpack_from("<I", buf, pos + 8)[0], pos + 12
+    if not vr.isalpha() or not vr.isupper():
+        raise ValueError(f"Unexpected VR {vr!r}")
+    return tag, vr, struct.unpack_from("<H", buf, pos + 6)[0], pos + 8
+
+
+def _skip_sequence(buf: bytes, pos: int, explicit: bool) -> int:
+    """Position after an undefined length sequence starting at pos (its first item)."""
+    while True:
+        tag, _, length, pos = _element_header(buf, pos, explicit=False)
+        if tag == SEQUENCE_END:
+            return pos
+        if tag != ITEM:
+            raise ValueError(f"Unexpected tag {tag:08X} in a sequence")
+        if length != UNDEFINED_LENGTH:
+            pos += length
+            continue
+        while True: # item of undefined length, its elements up to the item delimiter
+            tag, vr, length, pos = _element_header(buf, pos, explicit)
+            if tag == ITEM_END:
+                break
+            # UN with undefined length holds an implicit VR sequence
+            pos = _skip_sequence(buf, pos, explicit and vr != b"UN") if length == UNDEFINED_LENGTH else pos + length
+
+
+def _parse_prefix(buf: bytes, at_eof: bool) -> Optional[Dict[int, RawDataElement]]:
+    """
+    Raw elements of the needed tags from the start of a Part 10 file, None if the file is not one this reader handles
+    (no preamble, big endian or deflated). Raises _Truncated if the prefix is too short.
+    """
+    if len(buf) < 132 or buf[128:132] != b"DICM":
+        return None
+    pos, transfer_syntax = 132, None
+    while True:  # file meta group, always explicit VR little endian
+        if at_eof and pos >= len(buf):
+            return None
+        if pos + 2 > len(buf):
+            raise _Truncated
+        if struct.unpack_from("<H", buf, pos)[0] != 0x0002:  # the dataset may use another encoding, peek first
+            break
+        tag, _, length, value_start = _element_header(buf, pos, explicit=True)
+        if value_start + length > len(buf):
+            raise _Truncated
+        if tag == 0x00020010:
+            transfer_syntax = UID(buf[value_start:value_start + length].rstrip(b"\0 ").decode("ascii"))
+        pos = value_start + length
+    if transfer_syntax is None or not transfer_syntax.is_transfer_syntax or not transfer_syntax.is_little_endian or transfer_syntax.is_deflated:
+        return None
+
+    explicit = not transfer_syntax.is_implicit_VR
+    found = {}
+    while not (at_eof and pos >= len(buf)):
+        tag, vr, length, value_start = _element_header(buf, pos, explicit)
+        if tag > LAST_TAG:
+            break
+        if length == UNDEFINED_LENGTH:
+            if tag == SPECIFIC_CHARACTER_SET or tag in HEADER_TAGS:
+                return None
+            pos = _skip_sequence(buf, value_start, explicit and vr != b"UN")
+            continue
+        pos = value_start + length
+        if tag == SPECIFIC_CHARACTER_SET or tag in HEADER_TAGS:
+            if pos > len(buf):
+                raise _Truncated
+            found[tag] = RawDataElement(Tag(tag), vr.decode("ascii") if vr else None, length, buf[value_start:pos],
+                                        value_start, not explicit, True, True, False)
+    return found
+
+
+def read_header_fast(path: PathLike) -> Optional[DicomHeader]:
+    """
+    Sorting tags from the first few KB of the file, growing the read only if the tags are further in.
+    The values are converted by pydicom exactly like dcmread would, None means the fast path does not apply.
+    """
+    with open(path, "rb") as fh:
+        buf = b""
+        for size in PREFIX_SIZES:
+            buf += fh.read(size - len(buf))
+            try:
+                found = _parse_prefix(buf, at_eof=len(buf) < size)
+                break
+            except _Truncated:
+                if len(buf) < size:
+                    return None # file ends in the middle of an element
+        else:
+            return None
+    if found is None:
+        return None
+
+    encodings = None
+    if SPECIFIC_CHARACTER_SET in found:
+        encodings = convert_encodings(convert_raw_data_element(found[SPECIFIC_CHARACTER_SET]).value)
+    values = {}
+    for tag, (field_name, default) in HEADER_TAGS.items():
+        value = convert_raw_data_element(found[tag], encoding=encodings).value if tag in found else default
+        values[field_name] = str(value)
+    return DicomHeader(**values)
+
+
+def read_header(path: PathLike) -> DicomHeader:
+    """Sorting tags of one file, the byte-prefix reader with pydicom as fallback for everything it doesn't handle."""
+    try:
+        header = read_header_fast(path)
+    except Exception:
+        header = None
+    return header if header is not None else read_header_pydicom(path)
@@ -0,0 +1,117 @@
+import os
+import sqlite3
+from collections import deque
+from dataclasses import astuple, fields
+from pathlib import Path
+from typing import Dict, Iterator, Optional, Tuple, Union
+
+from utils.dicom_headers import DicomHeader, PathLike, read_headers, walk_entries
+
+HEADER_FIELDS = [f.name for f in fields(DicomHeader)]
+SCHEMA_VERSION = 1  # bump when DicomHeader or the reader output changes, old indexes are rebuilt
+COMMIT_EVERY = 1000  # new rows per transaction while scanning
+
+
+class HeaderIndex:
+    """
+    SQLite index of the sorting tags of every file below a raw DICOM folder, stored next to it as <folder>_dicom_index.sqlite.
+    A file is only read again if its size or mtime changed, so reopening a study costs one directory walk instead of
+    parsing every header. Paths are stored relative to the folder, so the index stays valid if the folder is moved together
+    with the index file next to it. Moving only the folder leaves the index behind and the next scan starts a new one.
+    """
+
+    def __init__(self, root: PathLike, index_path: Optional[PathLike] = None):
+        self.root = Path(root)
+        self.path = Path(index_path) if index_path else self.root.parent / f"{self.root.name}_dicom_index.sqlite"
+
+    def _connect(self) -> Optional[sqlite3.Connection]:
+        """Connection with the table in place, None if the index can't be written (read-only share etc.)."""
+        try:
+            conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)  # the GUI scan and a run may open it at the same time
+            if conn.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+                conn.execute("DROP TABLE IF EXISTS headers")
+                conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            conn.execute(f"CREATE TABLE IF NOT EXISTS headers (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, "
+                         f"{', '.join(f'{name} TEXT' for name in HEADER_FIELDS)})")
+            conn.commit()
+            return conn
+        except sqlite3.Error as e:
+            print(f"Header index {self.path} not usable, reading all headers: {e}")
+            return None
+
+    def _relative(self, path: str) -> str:
+        return os.path.relpath(path, self.root).replace(os.sep, "/")
+
+    def scan(self, max_workers: int = 32) -> Iterator[Tuple[str, Union[DicomHeader, Exception]]]:
+        """
+        (path, header) for every file below root, like scan_headers. Unchanged files come straight from the index,
+        the rest is read by the threaded reader and added. Rows of files that are gone are dropped after a full walk.
+        Unreadable files are not stored, they are tried again next time.
+        """
+        conn = self._connect()
+        cached = {}
+        if conn is not None:
+            for row in conn.execute(f"SELECT path, size, mtime_ns, {', '.join(HEADER_FIELDS)} FROM headers"):
+                cached[row[0]] = (row[1], row[2], DicomHeader(*row[3:]))
+
+        seen, stats, new_rows = set(), {}, []
+        hits = deque()  # unchanged files found by the walk, handed out between the reads
+
+        def misses() -> Iterator[str]:
+            for entry in walk_entries(self.root):
+                rel = self._relative(entry.path)
+                seen.add(rel)
+                try:
+                    st = entry.stat()
+                except OSError:
+                    yield entry.path
+                    continue
+                key = (st.st_size, st.st_mtime_ns)
+                hit = cached.get(rel)
+                if hit is not None and hit[:2] == key:
+                    hits.append((entry.path, hit[2]))
+                    continue
+                stats[entry.path] = key
+                yield entry.path
+
+        completed = False
+        try:
+            for path, header in read_headers(misses(), max_workers=max_workers):
+                while hits:
+                    yield hits.popleft()
+                if not isinstance(header, Exception) and path in stats:
+                    new_rows.append((self._relative(path), *stats.pop(path), *astuple(header)))
+                    if conn is not None and len(new_rows) >= COMMIT_EVERY:
+                        self._store(conn, new_rows)
+                yield path, header
+            while hits:
+                yield hits.popleft()
+            completed = True
+        finally:
+            if conn is not None:
+                self._store(conn, new_rows)
+                if completed:
+                    gone = [(rel,) for rel in cached.keys() - seen]
+                    if gone:
+                        conn.executemany("DELETE FROM headers WHERE path = ?", gone)
+                        conn.commit()
+                conn.close()
+
+    @staticmethod
+    def _store(conn: sqlite3.Connection, rows: list) -> None:
+        if rows:
+            placeholders = ", ".join("?" * (3 + len(HEADER_FIELDS)))
+            conn.executemany(f"INSERT OR REPLACE INTO headers VALUES ({placeholders})", rows)
+            conn.commit()
+            rows.clear()
+
+    def headers(self) -> Dict[str, DicomHeader]:
+        """Everything in the index as {absolute path: header}, no walk and no reads. Run scan first to bring it up to date."""
+        conn = self._connect()
+        if conn is None:
+            return {}
+        try:
+            return {str(self.root / rel): DicomHeader(*values)
+                    for rel, *values in conn.execute(f"SELECT path, {', '.join(HEADER_FIELDS)} FROM headers")}
+        finally:
+            conn.close()
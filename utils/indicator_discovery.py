@@ -0,0 +1,73 @@
+import os
+from typing import Callable, Iterator, Optional
+
+from utils.dicom_headers import DicomHeader, PathLike, read_headers
+from utils.header_index import HeaderIndex
+
+NIFTI_SUFFIXES = ('.nii', '.nii.gz')
+
+
+def sample_files(root: PathLike) -> Iterator[str]:
+    """First file of every directory below root, exports mostly keep one series per folder."""
+    stack = [os.fspath(root)]
+    while stack:
+        directory = stack.pop()
+        sampled = False
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif not sampled and entry.is_file():
+                        sampled = True
+                        yield entry.path
+        except OSError as e:
+            print(f"Could not list {directory}: {e}")
+
+
+def discover_indicators(root: PathLike, on_indicator: Callable[[str], None],
+                        should_stop: Callable[[], bool] = lambda: False, max_workers: int = 16) -> Optional[str]:
+    """
+    Calls on_indicator once for every distinct SeriesDescription below root, as soon as it is found.
+    A quick pass reads one file per directory, then a full pass through the header index picks up series that share
+    a folder (and leaves the index warm for the conversion). Both stop when should_stop() turns true.
+    Returns the first NIfTI file found, the scan stops there as the folder is no DICOM input.
+    """
+    found = set()
+
+    def report(header) -> None:
+        if isinstance(header, Exception):
+            return  # Skip unreadable files
+        # non-DICOM files come back with the default
+        desc = header.series_description
+        if desc and desc != DicomHeader.series_description and desc not in found:
+            found.add(desc)
+            on_indicator(desc)
+
+    nifti = []
+
+    def samples() -> Iterator[str]:
+        for path in sample_files(root):
+            if path.endswith(NIFTI_SUFFIXES):
+                nifti.append(path)
+                return
+            yield path
+
+    for _, header in read_headers(samples(), max_workers=max_workers):
+        if should_stop():
+            return None
+        report(header)
+    if nifti:
+        return nifti[0]
+
+    scan = HeaderIndex(root).scan(max_workers=max_workers)
+    try:
+        for path, header in scan:
+            if should_stop():
+                return None
+            if path.endswith(NIFTI_SUFFIXES):
+                return path
+            report(header)
+    finally:
+        scan.close()
+    return None
@@ -0,0 +1,77 @@
+import numpy as np
+import nibabel as nib
+from pathlib import Path
+from typing import Any, Dict, Tuple, Union
+
+PathLike = Union[str, Path]
+
+# Candidate dtypes for labels, smallest first
+_COMPACT_DTYPES = (np.uint8, np.uint16, np.int16, np.int32)
+
+
+def compact_label_dtype(min_value: int, max_value: int) -> np.dtype:
+    """Smallest integer dtype that holds every label between min_value and max_value."""
+    for dtype in _COMPACT_DTYPES:
+        info = np.iinfo(dtype)
+        if info.min <= min_value and max_value <= info.max:
+            return np.dtype(dtype)
+    return np.dtype(np.int64)
+
+
+def to_label_array(data: np.ndarray, atol: float = 1e-3, source: str = "labelmap") -> np.ndarray:
+    """
+    Turn scaled or float labelmap data into a compact integer array.
+    Values further than atol away from an integer mean this is not a labelmap (e.g. an image was passed).
+    """
+    data = np.asarray(data)
+    if np.issubdtype(data.dtype, np.integer):
+        return data
+    if data.size == 0:
+        return data.astype(np.uint8)
+    rounded = np.rint(data)
+    if not np.allclose(rounded, data, rtol=0, atol=atol):
+        raise ValueError(f"{source} contains non-integer values, expected a labelmap.")
+    return rounded.astype(compact_label_dtype(int(rounded.min()), int(rounded.max())))
+
+
+def load_labelmap(path: PathLike) -> Tuple[np.ndarray, Any]:
+    """
+    Load a NIfTI labelmap in its on-disk integer dtype instead of get_fdata()'s float64.
+
+    Integer files without scaling (what nnUNet writes) are read raw from dataobj, a uint8 labelmap stays
+    uint8 and uses 1/8 of the memory. Scaled or float files are scaled once, checked for integer values and
+    cast to the smallest fitting dtype. Returns (labels, nii_img), the image still gives affine and header.
+    """
+    nii_img = nib.load(str(path))
+    proxy = nii_img.dataobj
+    disk_dtype = nii_img.get_data_dtype()
+    slope = getattr(proxy, "slope", 1.0)
+    inter = getattr(proxy, "inter", 0.0)
+    unscaled = (slope is None or slope == 1.0) and (inter is None or inter == 0.0)
+
+    if np.issubdtype(disk_dtype, np.integer) and unscaled and hasattr(proxy, "get_unscaled"):
+        return np.asarray(proxy.get_unscaled()), nii_img
+
+    # Scaled integers or floats on disk, let nibabel apply the scaling and validate the result
+    return to_label_array(np.asanyarray(proxy), source=Path(str(path)).name), nii_img
+
+
+def label_histogram(labels: np.ndarray, chunk_voxels: int = 1 << 24) -> Dict[int, int]:
+    """
+    Voxel count of every non-zero label with a min, a max and a chunked np.bincount, instead of a comparison per label.
+    bincount works on intp, so the volume is counted in chunks to keep the temporary copy small. The volume is
+    flattened in memory order, nibabel arrays are usually Fortran ordered and reshape(-1) would copy them.
+    """
+    flat = np.asarray(labels).ravel(order='K')
+    if flat.size == 0:
+        return {}
+    low = int(flat.min())
+    shift = -low if low < 0 else 0
+    length = int(flat.max()) + shift + 1
+    counts = np.zeros(length, dtype=np.int64)
+    for start in range(0, flat.size, chunk_voxels):
+        chunk = flat[start:start + chunk_voxels].astype(np.intp)
+        if shift:
+            chunk += shift
+        counts += np.bincount(chunk, minlength=length)
+    return {int(value) - shift: int(count) for value, count in enumerate(counts) if count and value != shift}
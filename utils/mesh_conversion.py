@@ -0,0 +1,30 @@
+import numpy as np
+import pyvista as pv
+
+
+def vtk_face_array(faces: np.ndarray) -> np.ndarray:
+    """Triangles (n, 3) to VTK's flat cell array [3, a, b, c, 3, ...] in one int64 buffer."""
+    faces = np.asarray(faces)
+    cells = np.empty((len(faces), 4), dtype=np.int64)
+    cells[:, 0] = 3
+    cells[:, 1:] = faces
+    return cells.ravel()
+
+
+def to_polydata(vertices: np.ndarray, faces: np.ndarray) -> pv.PolyData:
+    """
+    PolyData without copying the points, VTK uses the float64 buffer directly (deep=False).
+    Keep the vertices array alive and unchanged while the mesh is in use.
+    """
+    vertices = np.ascontiguousarray(vertices, dtype=np.float64)
+    return pv.PolyData(vertices, vtk_face_array(faces), deep=False)
+
+
+def points_of(mesh: pv.PolyData) -> np.ndarray:
+    """Points of a filter output as a plain float64 array, a view unless VTK stored them as float32."""
+    return np.asarray(mesh.points, dtype=np.float64)
+
+
+def faces_of(mesh: pv.PolyData) -> np.ndarray:
+    """(n, 3) triangles of an all-triangle PolyData."""
+    return np.asarray(mesh.faces).reshape(-1, 4)[:, 1:]
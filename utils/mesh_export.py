@@ -0,0 +1,171 @@
+import os
+import io
+import json
+import struct
+import zipfile
+import datetime
+import numpy as np
+from pathlib import Path
+from typing import Literal, Union
+
+PathLike = Union[str, Path]
+STLWriter = Literal['numpy-stl', 'native']
+MeshFormat = Literal['stl', 'ply', '3mf', 'glb']
+
+# Same record layout as numpy-stl's mesh.Mesh.dtype: 50 bytes per triangle
+STL_DTYPE = np.dtype([
+    ('normals', np.float32, (3,)),
+    ('vectors', np.float32, (3, 3)),
+    ('attr', np.uint16, (1,)),
+])
+HEADER_FORMAT = '{package_name} ({version}) {now} {name}'
+
+
+def triangle_vectors(vertices: np.ndarray, faces: np.ndarray) -> np.ndarray:
+    """(n_faces, 3, 3) float32 corner coordinates in one fancy-indexing step instead of a loop per face."""
+    return np.ascontiguousarray(np.asarray(vertices)[np.asarray(faces, dtype=np.int64)], dtype=np.float32)
+
+
+def stl_records(vertices: np.ndarray, faces: np.ndarray) -> np.ndarray:
+    """Binary STL records with normals computed exactly like numpy-stl's update_normals (unnormalized float32 cross)."""
+    vectors = triangle_vectors(vertices, faces)
+    records = np.zeros(len(vectors), dtype=STL_DTYPE)
+    records['vectors'] = vectors
+    records['normals'] = np.cross(vectors[:, 1] - vectors[:, 0], vectors[:, 2] - vectors[:, 0])
+    return records
+
+
+def _write_stl_native(path: PathLike, vertices: np.ndarray, faces: np.ndarray) -> None:
+    records = stl_records(vertices, faces)
+    header = HEADER_FORMAT.format(package_name='Segment_App', version='native', now=datetime.datetime.now(),
+                                  name=os.path.split(str(path))[-1])
+    with open(path, 'wb') as fh:
+        fh.write(header[:80].ljust(80, ' ').encode('ascii', errors='replace'))
+        fh.write(np.uint32(len(records)).astype('<u4').tobytes())
+        records.tofile(fh)
+
+
+def _write_stl_numpy_stl(path: PathLike, vertices: np.ndarray, faces: np.ndarray) -> None:
+    from stl import mesh  # only needed for this writer
+
+    stl_mesh = mesh.Mesh(np.zeros(len(faces), dtype=mesh.Mesh.dtype))
+    stl_mesh.vectors[:] = triangle_vectors(vertices, faces)
+    stl_mesh.save(path)
+
+
+def write_stl(path: PathLike, vertices: np.ndarray, faces: np.ndarray, writer: STLWriter = 'numpy-stl') -> None:
+    """
+    Write a binary STL from an indexed mesh.
+    'numpy-stl' fills mesh.Mesh in one vectorized assignment and lets numpy-stl save it,
+    'native' writes the same triangle records from a contiguous buffer without importing numpy-stl.
+    Both produce identical bytes after the 80 byte header, which only holds the generator name and a timestamp.
+    """
+    if writer == 'native':
+        _write_stl_native(path, vertices, faces)
+    elif writer == 'numpy-stl':
+        _write_stl_numpy_stl(path, vertices, faces)
+    else:
+        raise ValueError(f"Unknown STL writer: {writer}")
+
+
+def _write_ply(path: PathLike, vertices: np.ndarray, faces: np.ndarray) -> None:
+    """Binary little endian PLY, every vertex stored once (float32) and the faces as uchar count + 3 int32 indices."""
+    face_records = np.empty(len(faces), dtype=np.dtype([('count', 'u1'), ('indices', '<i4', (3,))]))
+    face_records['count'] = 3
+    face_records['indices'] = faces
+    header = (f"ply\nformat binary_little_endian 1.0\ncomment Segment_App\n"
+              f"element vertex {len(vertices)}\nproperty float x\nproperty float y\nproperty float z\n"
+              f"element face {len(faces)}\nproperty list uchar int vertex_indices\nend_header\n")
+    with open(path, 'wb') as fh:
+        fh.write(header.encode('ascii'))
+        np.ascontiguousarray(vertices, dtype='<f4').tofile(fh)
+        face_records.tofile(fh)
+
+
+THREEMF_CONTENT_TYPES = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="model" ContentType="application/vnd.ms-package.3dmanufacturing-3dmodel+xml"/>'
+    '</Types>')
+THREEMF_RELS = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Target="/3D/3dmodel.model" Id="rel0" Type="http://schemas.microsoft.com/3dmanufacturing/2013/01/3dmodel"/>'
+    '</Relationships>')
+
+
+def _write_3mf(path: PathLike, vertices: np.ndarray, faces: np.ndarray) -> None:
+    """3MF package (deflate compressed zip) with one mesh object in millimeters."""
+    model = io.StringIO()
+    model.write('<?xml version="1.0" encoding="UTF-8"?>\n'
+                '<model unit="millimeter" xml:lang="en-US" xmlns="http://schemas.microsoft.com/3dmanufacturing/core/2015/02">\n'
+                '<resources><object id="1" type="model"><mesh><vertices>\n')
+    # savetxt formats the whole array in C, a python f-string per vertex is several times slower for large meshes
+    np.savetxt(model, np.asarray(vertices, dtype=np.float32), fmt='<vertex x="%.7g" y="%.7g" z="%.7g"/>')
+    model.write('</vertices><triangles>\n')
+    np.savetxt(model, np.asarray(faces, dtype=np.int64), fmt='<triangle v1="%d" v2="%d" v3="%d"/>')
+    model.write('</triangles></mesh></object></resources>\n<build><item objectid="1"/></build>\n</model>\n')
+
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.writestr('[Content_Types].xml', THREEMF_CONTENT_TYPES)
+        archive.writestr('_rels/.rels', THREEMF_RELS)
+        archive.writestr('3D/3dmodel.model', model.getvalue())
+
+
+def _write_glb(path: PathLike, vertices: np.ndarray, faces: np.ndarray) -> None:
+    """
+    Binary glTF 2.0 with one indexed triangle primitive (float32 positions, uint32 indices).
+    Coordinates are written as they are (mm, LPS like the STL), glTF viewers assume meters so expect a scale of 1000.
+    """
+    positions = np.ascontiguousarray(vertices, dtype='<f4')
+    indices = np.ascontiguousarray(faces, dtype='<u4')
+    position_bytes = positions.tobytes()
+    index_offset = len(position_bytes)  # positions are 12 bytes per vertex, so the indices stay 4 byte aligned
+    binary = position_bytes + indices.tobytes()
+    binary += b'\x00' * (-len(binary) % 4)
+
+    gltf = {
+        "asset": {"version": "2.0", "generator": "Segment_App"},
+        "scene": 0,
+        "scenes": [{"nodes": [0]}],
+        "nodes": [{"mesh": 0}],
+        "meshes": [{"primitives": [{"attributes": {"POSITION": 0}, "indices": 1, "mode": 4}]}],
+        "buffers": [{"byteLength": len(binary)}],
+        "bufferViews": [
+            {"buffer": 0, "byteOffset": 0, "byteLength": index_offset, "target": 34962},
+            {"buffer": 0, "byteOffset": index_offset, "byteLength": indices.nbytes, "target": 34963},
+        ],
+        "accessors": [
+            {"bufferView": 0, "componentType": 5126, "count": len(positions), "type": "VEC3",
+             "min": positions.min(axis=0).tolist() if len(positions) else [0, 0, 0],
+             "max": positions.max(axis=0).tolist() if len(positions) else [0, 0, 0]},
+            {"bufferView": 1, "componentType": 5125, "count": indices.size, "type": "SCALAR"},
+        ],
+    }
+    json_chunk = json.dumps(gltf, separators=(',', ':')).encode()
+    json_chunk += b' ' * (-len(json_chunk) % 4)
+
+    with open(path, 'wb') as fh:
+        fh.write(struct.pack('<4sII', b'glTF', 2, 12 + 8 + len(json_chunk) + 8 + len(binary)))
+        fh.write(struct.pack('<I4s', len(json_chunk), b'JSON'))
+        fh.write(json_chunk)
+        fh.write(struct.pack('<I4s', len(binary), b'BIN\x00'))
+        fh.write(binary)
+
+
+MESH_WRITERS = {'ply': _write_ply, '3mf': _write_3mf, 'glb': _write_glb}
+
+
+def write_mesh(path: PathLike, vertices: np.ndarray, faces: np.ndarray, output_format: MeshFormat = 'stl',
+               stl_writer: STLWriter = 'numpy-stl') -> None:
+    """
+    Write an indexed mesh in one of the output formats, the extension of path is not checked.
+    STL repeats every vertex in each of its triangles, PLY, 3MF and GLB store shared vertices once and are a lot smaller.
+    """
+    if output_format == 'stl':
+        write_stl(path, vertices, faces, writer=stl_writer)
+    elif output_format in MESH_WRITERS:
+        MESH_WRITERS[output_format](path, vertices, faces)
+    else:
+        raise ValueError(f"Unknown mesh format: {output_format}")
@@ -0,0 +1,66 @@
+import numpy as np
+import scipy.sparse as sp
+
+# Taubin's lambda, mu follows from the pass band k_pb = 1/lambda + 1/mu
+TAUBIN_LAMBDA = 0.5
+
+
+def umbrella_operator(n_vertices: int, faces: np.ndarray) -> sp.csr_matrix:
+    """
+    Row-normalized vertex adjacency W as CSR, (W @ x)[i] is the mean of the neighbours of vertex i.
+    Vertices without an edge keep their position (identity row).
+    """
+    faces = np.asarray(faces, dtype=np.int64)
+    rows = np.concatenate([faces[:, 0], faces[:, 1], faces[:, 2], faces[:, 1], faces[:, 2], faces[:, 0]])
+    cols = np.concatenate([faces[:, 1], faces[:, 2], faces[:, 0], faces[:, 0], faces[:, 1], faces[:, 2]])
+    adjacency = sp.csr_matrix((np.ones(len(rows)), (rows, cols)), shape=(n_vertices, n_vertices))
+    adjacency.data[:] = 1.0  # every edge is shared by two faces, count it once
+
+    degree = np.asarray(adjacency.sum(axis=1)).ravel()
+    isolated = degree == 0
+    operator = sp.diags(1.0 / np.where(isolated, 1.0, degree)) @ adjacency
+    if isolated.any():
+        operator = operator + sp.diags(isolated.astype(np.float64))
+    return operator.tocsr()
+
+
+class SparseMeshSmoother:
+    """
+    Laplacian and Taubin smoothing as sparse mat-vecs, the topology (W) is built once per mesh.
+    Laplacian moves every vertex by relaxation_factor towards the mean of its neighbours (all at once,
+    VTK's vtkSmoothPolyDataFilter updates in place, so results are close but not identical).
+    Taubin is the classic lambda|mu scheme, not VTK's windowed sinc filter behind pyvista's smooth_taubin.
+    """
+
+    def __init__(self, n_vertices: int, faces: np.ndarray):
+        self.operator = umbrella_operator(n_vertices, faces)
+
+    def _step(self, vertices: np.ndarray, factor: float) -> np.ndarray:
+        return vertices + factor * (self.operator @ vertices - vertices)
+
+    def laplacian(self, vertices: np.ndarray, n_iter: int, relaxation_factor: float) -> np.ndarray:
+        vertices = np.array(vertices, dtype=np.float64)
+        for _ in range(n_iter):
+            vertices = self._step(vertices, relaxation_factor)
+        return vertices
+
+    def taubin(self, vertices: np.ndarray, n_iter: int, pass_band: float, lambda_: float = TAUBIN_LAMBDA) -> np.ndarray:
+        """n_iter shrink (lambda) / inflate (mu) pairs, pass_band is Taubin's k_pb."""
+        if not 0 < pass_band < 1 / lambda_:
+            raise ValueError(f"pass_band must be between 0 and {1 / lambda_}, got {pass_band}")
+        mu = 1.0 / (pass_band - 1.0 / lambda_)
+        vertices = np.array(vertices, dtype=np.float64)
+        for _ in range(n_iter):
+            vertices = self._step(self._step(vertices, lambda_), mu)
+        return vertices
+
+
+def smooth_vertices_sparse(vertices: np.ndarray, faces: np.ndarray, method: str = 'taubin', n_iter: int = 100,
+                           relaxation_factor: float = 0.1) -> np.ndarray:
+    """Same arguments as smooth_mesh_pyvista, relaxation_factor is the pass band for taubin."""
+    smoother = SparseMeshSmoother(len(vertices), faces)
+    if method == 'laplacian':
+        return smoother.laplacian(vertices, n_iter, relaxation_factor)
+    if method == 'taubin':
+        return smoother.taubin(vertices, n_iter, relaxation_factor)
+    raise ValueError(f"Unknown smoothing method: {method}")
@@ -0,0 +1,57 @@
+import re
+from collections import defaultdict
+from concurrent.futures import Executor
+from pathlib import Path
+from typing import Iterator, Union
+
+import numpy as np
+
+from utils.shared_labelmap import InMemoryLabelmap
+
+PathLike = Union[str, Path]
+CHANNEL_PATTERN = re.compile(r"^(?P<case>.+)_(?P<channel>\d{4})\.nii\.gz$")
+
+
+def supports_in_memory(predictor) -> bool:
+    """The axis order and affine below assume nnUNet's SimpleITK reader, other readers reorient the data."""
+    from nnunetv2.imageio.simpleitk_reader_writer import SimpleITKIO
+    return predictor.plans_manager.image_reader_writer_class is SimpleITKIO
+
+
+def sitk_affine(properties: dict) -> np.ndarray:
+    """RAS affine nibabel will read from a NIfTI SimpleITK writes with these properties (ITK geometry is LPS)."""
+    sitk_stuff = properties["sitk_stuff"]
+    affine = np.eye(4)
+    affine[:3, :3] = np.asarray(sitk_stuff["direction"]).reshape(3, 3) * np.asarray(sitk_stuff["spacing"])
+    affine[:3, 3] = sitk_stuff["origin"]
+    return np.diag([-1.0, -1.0, 1.0, 1.0]) @ affine
+
+
+def predict_labelmaps(predictor, inference_path: PathLike, labelmap_output_path: PathLike,
+                      archive_pool: Executor) -> Iterator[Union[str, InMemoryLabelmap]]:
+    """
+    Predict the cases in inference_path one by one and yield the labelmaps as arrays for ParallelSTLProcessor.run.
+    The .nii.gz is written by archive_pool in the background, same file as predict_from_files would write.
+    Cases whose labelmap exists already are yielded by name (like overwrite=False), they are read from disk.
+    """
+    from nnunetv2.imageio.simpleitk_reader_writer import SimpleITKIO
+
+    cases = defaultdict(list)
+    for image_file in sorted(Path(inference_path).iterdir()):
+        match = CHANNEL_PATTERN.match(image_file.name)
+        if match:
+            cases[match["case"]].append(image_file)
+
+    io = SimpleITKIO()
+    for case, image_files in sorted(cases.items()):
+        file_name = f"{case}.nii.gz"
+        output_file = Path(labelmap_output_path) / file_name
+        if output_file.exists():
+            yield file_name
+            continue
+        image, properties = io.read_images([str(f) for f in image_files])
+        segmentation = predictor.predict_single_npy_array(image, properties, None, None, False)
+        archive = archive_pool.submit(io.write_seg, segmentation, str(output_file), properties)
+        # SimpleITK arrays are (z, y, x), nibabel and the STL processor use (x, y, z)
+        yield InMemoryLabelmap(file_name=file_name, array=np.asarray(segmentation).transpose(2, 1, 0),
+                               affine=sitk_affine(properties), archive=archive)
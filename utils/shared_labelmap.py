@@ -0,0 +1,64 @@
+from concurrent.futures import Future
+from multiprocessing import shared_memory
+from typing import List, Optional, Tuple
+
+import numpy as np
+from pydantic import BaseModel, ConfigDict
+
+
+class InMemoryLabelmap(BaseModel):
+    """
+    A predicted labelmap handed to the STL processor without the .nii.gz round trip.
+    array is in nibabel (x, y, z) order, archive is the pending NIfTI write of the same labelmap, if any.
+    """
+    file_name: str
+    array: np.ndarray
+    affine: np.ndarray
+    archive: Optional[Future] = None
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
+
+class SharedLabelmap(BaseModel):
+    """Picklable reference to a labelmap in a shared memory block, the STL workers attach to it by name."""
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+    affine: List[List[float]]
+
+
+def share_labelmap(array: np.ndarray, affine: np.ndarray) -> Tuple[shared_memory.SharedMemory, SharedLabelmap]:
+    """Copy the labelmap into a new shared memory block. The caller owns the block and unlinks it when the task is done."""
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    ref = SharedLabelmap(name=shm.name, shape=array.shape, dtype=array.dtype.str, affine=np.asarray(affine).tolist())
+    return shm, ref
+
+
+def _attach(name: str) -> shared_memory.SharedMemory:
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)  # Python 3.13+, the worker only borrows the block
+    except TypeError:
+        # older versions register it again, harmless as the pool workers share the parent's resource tracker
+        return shared_memory.SharedMemory(name=name)
+
+
+def load_shared_labelmap(ref: SharedLabelmap) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (labelmap, affine) of a shared block. The labelmap is copied out (a memcpy, no gzip) and the block is
+    closed right away, so no view into it can outlive the mapping.
+    """
+    shm = _attach(ref.name)
+    try:
+        label_image = np.array(np.ndarray(ref.shape, dtype=np.dtype(ref.dtype), buffer=shm.buf))
+    finally:
+        shm.close()
+    return label_image, np.asarray(ref.affine)
+
+
+def release_shared(shm: shared_memory.SharedMemory) -> None:
+    shm.close()
+    try:
+        shm.unlink()
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,76 @@
+import os
+import sys
+import json
+import time
+import psutil
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, List, Tuple, Union
+
+PathLike = Union[str, Path]
+
+
+def memory_usage_mb() -> Tuple[float, float]:
+    """(current RSS, peak RSS of the process so far) in MB."""
+    info = psutil.Process().memory_info()
+    peak = getattr(info, "peak_wset", None)  # Windows
+    if peak is None:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak if sys.platform == "darwin" else peak * 1024  # kB on Linux, bytes on macOS
+    return round(info.rss / 2**20, 1), round(max(peak, info.rss) / 2**20, 1)
+
+
+class StageTimer:
+    """
+    Wall time and memory after each stage of one (file, label).
+    Peak RSS is the high-water mark of the worker process up to the end of the stage, not of the stage alone.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, dict] = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            rss, peak = memory_usage_mb()
+            self.stages[name] = {"wall_s": round(time.perf_counter() - start, 4), "rss_mb": rss, "peak_rss_mb": peak}
+
+    def record(self, **context) -> dict:
+        """One JSON line: the context (file, label, ...), worker pid, the stages and their total wall time."""
+        total = round(sum(stage["wall_s"] for stage in self.stages.values()), 4)
+        return {**context, "pid": os.getpid(), "total_s": total, "stages": self.stages}
+
+
+def append_timings(path: PathLike, records: List[dict]) -> None:
+    with open(path, "a") as fh:
+        for record in records:
+            fh.write(json.dumps(record) + "\n")
+
+
+def timing_summary(records: List[dict]) -> str:
+    """Table with count, total, mean and max wall time and the highest peak RSS per stage, slowest stage first."""
+    stages: Dict[str, List[dict]] = {}
+    for record in records:
+        for name, stage in record["stages"].items():
+            stages.setdefault(name, []).append(stage)
+    if not stages:
+        return "No stage timings recorded."
+
+    grand_total = sum(stage["wall_s"] for entries in stages.values() for stage in entries) or 1.0
+    lines = [f"{'Stage':<16}{'n':>6}{'total s':>11}{'mean s':>10}{'max s':>10}{'share':>8}{'peak MB':>10}"]
+    for name, entries in sorted(stages.items(), key=lambda item: -sum(stage["wall_s"] for stage in item[1])):
+        walls = [stage["wall_s"] for stage in entries]
+        lines.append(f"{name:<16}{len(walls):>6}{sum(walls):>11.2f}{sum(walls) / len(walls):>10.3f}{max(walls):>10.3f}"
+                     f"{100 * sum(walls) / grand_total:>7.1f}%{max(stage['peak_rss_mb'] for stage in entries):>10.0f}")
+
+    writes = [record["write_queue"] for record in records if record.get("write_queue")]
+    if writes:
+        latencies = [write["latency_s"] for write in writes]
+        lines.append(f"Write-behind: {len(writes)} writes, latency mean {sum(latencies) / len(latencies):.3f}s max {max(latencies):.3f}s, "
+                     f"queue depth mean {sum(write['depth'] for write in writes) / len(writes):.1f} max {max(write['depth'] for write in writes)}, "
+                     f"workers blocked {sum(write['wait_s'] for write in writes):.2f}s on a full queue")
+    return "\n".join(lines)
@@ -0,0 +1,111 @@
+import os
+import json
+import hashlib
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+PathLike = Union[str, Path]
+
+
+def file_sha256(path: PathLike, chunk_size: int = 1 << 20) -> str:
+    """Content hash of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def params_hash(payload: dict) -> str:
+    """Hash of a json serializable parameter dict, independent of key order."""
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+class STLManifest:
+    """
+    The STL checkpoint (.stl_processing_checkpoint.json).
+    Besides the completed/failed file names it stores, per labelmap, the content hash (cached by size and mtime)
+    and per label the hashes the STL was built from, its output files and its metadata entries.
+    A label is only rebuilt if the labelmap, its parameters or its output changed.
+    """
+
+    def __init__(self, path: PathLike, resume: bool = True):
+        self.path = Path(path)
+        data = json.loads(self.path.read_text()) if self.path.exists() else {}
+        self.files: Dict[str, dict] = data.get("files", {})
+        self.costs: Dict[str, int] = data.get("costs", {})  # only hints, kept even without resume
+        self.completed: List[str] = data.get("completed", []) if resume else []
+        self.failed: List[dict] = data.get("failed", []) if resume else []
+        if not resume:
+            # keep the hash cache, forget what was built
+            for record in self.files.values():
+                record["labels"] = {}
+
+    def content_hash(self, path: PathLike) -> str:
+        """sha256 of the file, only recomputed when size or mtime changed."""
+        path = Path(path)
+        stat = path.stat()
+        record = self.files.setdefault(path.name, {"labels": {}})
+        if record.get("size") != stat.st_size or record.get("mtime_ns") != stat.st_mtime_ns or "sha256" not in record:
+            record.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns, sha256=file_sha256(path))
+        return record["sha256"]
+
+    def _fresh(self, file_name: str, label: int, source: str, label_hash: str, output_root: Path,
+               expected_output: Optional[str] = None) -> bool:
+        entry = self.files.get(file_name, {}).get("labels", {}).get(str(label))
+        if entry is None or entry["source"] != source or entry["params"] != label_hash:
+            return False
+        if expected_output is not None and entry["outputs"] and entry["outputs"] != [expected_output]:
+            return False  # built under another name
+        return all((output_root / output).exists() for output in entry["outputs"])
+
+    def stale_labels(self, file_name: str, source: str, label_hashes: Dict[int, str], output_root: Path,
+                     expected_outputs: Optional[Dict[int, str]] = None) -> List[int]:
+        """Labels of a file that have to be (re)built, in the order of label_hashes."""
+        expected_outputs = expected_outputs or {}
+        return [label for label, label_hash in label_hashes.items()
+                if not self._fresh(file_name, label, source, label_hash, output_root, expected_outputs.get(label))]
+
+    def record_label(self, file_name: str, label: int, source: str, label_hash: str,
+                     outputs: List[str], metadata: list) -> List[str]:
+        """Store a built label, returns the outputs of the previous build that are not outputs anymore."""
+        labels = self.files.setdefault(file_name, {"labels": {}}).setdefault("labels", {})
+        previous = labels.get(str(label), {}).get("outputs", [])
+        labels[str(label)] = {"source": source, "params": label_hash, "outputs": outputs, "metadata": metadata}
+        return [output for output in previous if output not in outputs]
+
+    def label_metadata(self, file_name: str, source: str, label_hashes: Dict[int, str]) -> list:
+        """Metadata entries of every label that is up to date, for regenerating stl_metadata.json."""
+        labels = self.files.get(file_name, {}).get("labels", {})
+        entries = []
+        for label, label_hash in label_hashes.items():
+            entry = labels.get(str(label))
+            if entry is not None and entry["source"] == source and entry["params"] == label_hash:
+                entries.extend(tuple(item) for item in entry["metadata"])
+        return entries
+
+    def record_histogram(self, file_name: str, source: str, histogram: Dict[int, int]) -> None:
+        record = self.files.setdefault(file_name, {"labels": {}})
+        record["histogram"] = {"source": source, "counts": {str(label): count for label, count in histogram.items()}}
+
+    def histogram(self, file_name: str, source: str) -> Optional[Dict[int, int]]:
+        """Voxel count per label of the labelmap with this content hash, None if not cached."""
+        cached = self.files.get(file_name, {}).get("histogram")
+        if cached is None or cached["source"] != source:
+            return None
+        return {int(label): count for label, count in cached["counts"].items()}
+
+    def rebase_source(self, file_name: str, old_source: str, new_source: str) -> None:
+        """Move the labels and histogram built from old_source (e.g. an in-memory labelmap) to new_source."""
+        record = self.files.get(file_name, {})
+        for entry in record.get("labels", {}).values():
+            if entry["source"] == old_source:
+                entry["source"] = new_source
+        if record.get("histogram", {}).get("source") == old_source:
+            record["histogram"]["source"] = new_source
+
+    def save(self) -> None:
+        data = {"completed": self.completed, "failed": self.failed, "costs": self.costs, "files": self.files}
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        tmp_path.write_text(json.dumps(data, indent=2))
+        os.replace(tmp_path, self.path)  # a crash while writing never leaves a broken checkpoint
@@ -0,0 +1,71 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, List, Optional
+
+from utils.stage_timing import StageTimer
+
+
+class WriteBehindQueue:
+    """
+    Writer threads with a bounded queue, the caller goes on meshing while the file is written.
+    submit blocks once max_pending writes are queued, so finished meshes can't pile up in memory.
+    max_workers=0 writes synchronously in the calling thread.
+    """
+
+    def __init__(self, max_workers: int = 1, max_pending: int = 4):
+        self.max_workers, self.max_pending = max_workers, max_pending
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="mesh_writer") if max_workers > 0 else None
+        self.slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self.lock = threading.Lock()
+        self.pending = 0
+        self.futures: List[Future] = []
+
+    def submit(self, fn: Callable, *args, timer: Optional[StageTimer] = None) -> dict:
+        """
+        Queue fn(*args), its wall time ends up as the "write" stage of timer.
+        Returns the queue stats of this write (queue depth at submit, time blocked, submit to written latency),
+        filled in once the write is done.
+        """
+        timer = timer or StageTimer()
+        stats = {}
+        start = time.perf_counter()
+        self.slots.acquire()
+        with self.lock:
+            stats.update(depth=self.pending, wait_s=round(time.perf_counter() - start, 4))
+            self.pending += 1
+
+        def run():
+            try:
+                with timer.stage("write"):
+                    fn(*args)
+            finally:
+                with self.lock:
+                    self.pending -= 1
+                self.slots.release()
+                stats["latency_s"] = round(time.perf_counter() - start, 4)
+
+        if self.executor is None:
+            run()
+        else:
+            self.futures.append(self.executor.submit(run))
+        return stats
+
+    def drain(self, raise_errors: bool = True) -> None:
+        """Wait for every queued write, raises the first write error."""
+        futures, self.futures = self.futures, []
+        errors = [future.exception() for future in futures]
+        for error in errors:
+            if error is not None and raise_errors:
+                raise error
+
+
+_shared_queue: Optional[WriteBehindQueue] = None
+
+
+def shared_write_queue(max_workers: int, max_pending: int) -> WriteBehindQueue:
+    """One queue per (worker) process, the pool processes live for the whole run so the threads are reused."""
+    global _shared_queue
+    if _shared_queue is None or (_shared_queue.max_workers, _shared_queue.max_pending) != (max_workers, max_pending):
+        _shared_queue = WriteBehindQueue(max_workers, max_pending)
+    return _shared_queue